@@ -0,0 +1,88 @@
+# coding=utf-8
+
+# pynfa
+# Copyright (C) 2015  Örjan Gustavsson
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+"""
+Compare throughput of matching a batch of inputs one test_input call at
+a time against the batch APIs match_many, test_inputs and
+match_many_parallel.
+
+Usage:
+   python bench/bench_batch.py [no_of_inputs]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from nfa import NFA  # noqa: E402
+
+ALPHABET = 'abcd'
+
+
+def build():
+    """Union of 30 random words, starred and followed by 'dd'"""
+    rnd = random.Random(1)
+    nfa = None
+    for _ in range(30):
+        w = NFA(ALPHABET)
+        w.build_from_string(''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(2, 5))))
+        nfa = w if nfa is None else nfa + w
+    tail = NFA(ALPHABET)
+    tail.build_from_string('dd')
+    return nfa.star() | tail
+
+
+def main(argv):
+    no_of_inputs = int(argv[1]) if len(argv) > 1 else 50000
+    rnd = random.Random(0)
+    inputs = [''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(1, 16))) for _ in range(no_of_inputs)]
+    nfa = build()
+
+    def loop():
+        return [nfa.test_input(v) for v in inputs]
+
+    def batch():
+        return nfa.test_inputs(inputs)
+
+    def generator():
+        return list(nfa.match_many(inputs))
+
+    def parallel():
+        return list(nfa.match_many_parallel(inputs, chunk_size=2000))
+
+    assert [bool(r) for r in batch()] == loop() == generator()
+
+    print('{:<28} {:>10} {:>14}'.format('method', 'seconds', 'inputs/sec'))
+    for lazy in (False, True):
+        if lazy:
+            nfa.enable_lazy_dfa()
+        for name, func in (('test_input loop', loop), ('match_many', generator), ('test_inputs', batch),
+                           ('match_many_parallel', parallel)):
+            seconds = min(timeit.repeat(func, number=1, repeat=3))
+            print('{:<28} {:>10.4f} {:>14.0f}'.format(
+                name + (' (lazy)' if lazy else ''), seconds, no_of_inputs / seconds))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
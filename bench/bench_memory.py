@@ -0,0 +1,73 @@
+# coding=utf-8
+
+# pynfa
+# Copyright (C) 2015  Örjan Gustavsson
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Compare memory use of the dense and sparse transition layouts.
+
+Builds the same automaton, a chain of literal strings over a byte
+alphabet, once per layout and reports the memory held by the NFA.
+
+Usage:
+   python bench/bench_memory.py [no_of_states]
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from nfa import NFA, Epsilon  # noqa: E402
+
+ALPHABET = [chr(i) for i in range(256)]
+
+
+def build(no_of_states, sparse):
+    nfa = NFA(ALPHABET, sparse=sparse)
+    prev = nfa.new_state(initial=True)
+    for i in range(no_of_states - 1):
+        sid = nfa.new_state(final=(i % 100 == 99))
+        nfa.new_edge(prev, ALPHABET[i % 256], sid)
+        if i % 10 == 0:
+            nfa.new_edge(prev, Epsilon, sid)
+        prev = sid
+    return nfa
+
+
+def measure(no_of_states, sparse):
+    tracemalloc.start()
+    nfa = build(no_of_states, sparse)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert nfa.no_of_states == no_of_states
+    return size, peak
+
+
+def main(argv):
+    no_of_states = int(argv[1]) if len(argv) > 1 else 2000
+    print('{:<8} {:>10} {:>14} {:>14}'.format('layout', 'states', 'bytes', 'bytes/state'))
+    for sparse in (False, True):
+        size, _ = measure(no_of_states, sparse)
+        print('{:<8} {:>10} {:>14} {:>14.1f}'.format(
+            'sparse' if sparse else 'dense', no_of_states, size, float(size) / no_of_states))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
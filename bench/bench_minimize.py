@@ -0,0 +1,122 @@
+# coding=utf-8
+
+# pynfa
+# Copyright (C) 2015  Örjan Gustavsson
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+"""
+Measure DFA minimization on automata composed with +, | and star().
+
+For each workload the subset constructed DFA is minimized, and the state
+counts and the matching time of both compiled DFAs are reported.
+Then minimization itself is timed on chain DFAs of growing length, where
+every split removes a single state from a large block; the time should
+roughly double with the length, not quadruple.
+
+Usage:
+   python bench/bench_minimize.py [no_of_inputs]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from nfa import NFA, CompiledDFA  # noqa: E402
+
+ALPHABET = 'abcd'
+
+
+def word(string):
+    nfa = NFA(ALPHABET)
+    nfa.build_from_string(string)
+    return nfa
+
+
+def union_of_words(n):
+    rnd = random.Random(n)
+    nfa = word('abc')
+    for _ in range(n):
+        nfa = nfa + word(''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(2, 6))))
+    return nfa
+
+
+def nested_stars(n):
+    nfa = word('ab')
+    for i in range(n):
+        nfa = (nfa | word(ALPHABET[i % 4])).star() + word('cd')
+    return nfa
+
+
+def repeated_concat(n):
+    piece = (word('a') + word('b')).star()
+    nfa = piece
+    for _ in range(n):
+        nfa = nfa | piece
+    return nfa | word('c')
+
+
+def chain(n):
+    """DFA accepting only 'a' * (n - 1), with no two states equivalent"""
+    dfa = NFA(ALPHABET)
+    states = [dfa.new_state(initial=(i == 0), final=(i == n - 1)) for i in range(n)]
+    for p, q in zip(states, states[1:]):
+        dfa.new_edge(p, 'a', q)
+    return dfa
+
+
+WORKLOADS = [
+    ('union_of_words_40', lambda: union_of_words(40)),
+    ('nested_stars_6', lambda: nested_stars(6)),
+    ('repeated_concat_8', lambda: repeated_concat(8)),
+]
+
+
+def main(argv):
+    no_of_inputs = int(argv[1]) if len(argv) > 1 else 20000
+    rnd = random.Random(0)
+    inputs = [''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(1, 12))) for _ in range(no_of_inputs)]
+
+    print('{:<20} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+        'workload', 'nfa', 'dfa', 'min', 'dfa_s', 'min_s'))
+    for name, build in WORKLOADS:
+        nfa = build()
+        dfa = nfa.subset_construct_dfa()
+        mdfa, _ = dfa.minimize()
+        matcher = CompiledDFA(dfa)
+        min_matcher = CompiledDFA(mdfa)
+        assert [matcher.accepts(v) for v in inputs] == [min_matcher.accepts(v) for v in inputs]
+
+        dfa_time = min(timeit.repeat(lambda: [matcher.accepts(v) for v in inputs], number=1, repeat=3))
+        min_time = min(timeit.repeat(lambda: [min_matcher.accepts(v) for v in inputs], number=1, repeat=3))
+        print('{:<20} {:>8} {:>8} {:>8} {:>10.4f} {:>10.4f}'.format(
+            name, nfa.no_of_states, dfa.no_of_states, mdfa.no_of_states, dfa_time, min_time))
+
+    print()
+    print('{:<20} {:>8} {:>10}'.format('chain', 'states', 'min_s'))
+    for n in (1000, 2000, 4000, 8000):
+        dfa = chain(n)
+        min_time = min(timeit.repeat(dfa.minimize, number=1, repeat=3))
+        assert dfa.minimize()[0].no_of_states == n
+        print('{:<20} {:>8} {:>10.4f}'.format('chain_{}'.format(n), n, min_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,286 @@
+# coding=utf-8
+
+# pynfa
+# Copyright (C) 2015  Örjan Gustavsson
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+"""
+Benchmark suite for construction, determinization and matching.
+
+Workloads:
+   literals      union of words built with build_from_string
+   compositions  deep nesting of star(), | and +
+   blowup        (a|b)*a(a|b)^n, whose DFA has 2^(n+1) states
+   random        large random NFAs with epsilon edges
+
+For every workload the suite reports construction speed in states/sec,
+test_input speed in consumed symbols/sec and the peak memory traced
+while building. Results are written as JSON, so runs on different commits can
+be compared with --compare.
+
+Usage:
+   python bench/bench_suite.py [--scale N] [--repeat N] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from nfa import NFA, Epsilon  # noqa: E402
+
+
+def timed(func, repeat):
+    """
+    :return: Tuple (result of the last call, best wall time of repeat calls in seconds)
+    """
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        seconds = perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+def peak_memory(func):
+    """
+    :return: Peak number of bytes traced while calling func
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def random_inputs(rnd, alphabet, count, length):
+    return [''.join(rnd.choice(alphabet) for _ in range(length)) for _ in range(count)]
+
+
+def match_rate(nfa, inputs, repeat):
+    """
+    test_input stops reading an input once no state is active, so the
+    throughput is based on the symbols actually consumed, counted in an
+    untimed instrumented pass, rather than on the input lengths.
+
+    :return: Dict with the test_input throughput over inputs
+    """
+    stats = nfa.enable_stats()
+    try:
+        for v in inputs:
+            nfa.test_input(v)  # also builds the matching tables outside the timing
+        symbols = stats.counters.get('symbols', 0)
+    finally:
+        nfa.disable_stats()
+    _, seconds = timed(lambda: [nfa.test_input(v) for v in inputs], repeat)
+    return {
+        'input_symbols': sum(len(v) for v in inputs),
+        'symbols': symbols,
+        'match_seconds': seconds,
+        'symbols_per_sec': symbols / seconds,
+    }
+
+
+def construction(build, repeat):
+    """
+    :return: Tuple (NFA, dict with the construction speed and peak memory of build)
+    """
+    nfa, seconds = timed(build, repeat)
+    return nfa, {
+        'states': nfa.no_of_states,
+        'build_seconds': seconds,
+        'states_per_sec': nfa.no_of_states / seconds,
+        'peak_bytes': peak_memory(build),
+    }
+
+
+def bench_literals(scale, repeat):
+    rnd = random.Random(1)
+    alphabet = 'abcdefgh'
+    words = [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(3, 12))) for _ in range(50 * scale)]
+
+    def build():
+        nfas = []
+        for word in words:
+            nfa = NFA(alphabet)
+            nfa.build_from_string(word)
+            nfas.append(nfa)
+        return NFA.union_all(nfas)
+
+    nfa, result = construction(build, repeat)
+    inputs = words[:100] + random_inputs(rnd, alphabet, 100, 8)
+    result.update(match_rate(nfa, inputs, repeat))
+    return result
+
+
+def bench_compositions(scale, repeat):
+    alphabet = 'abc'
+    depth = 10 * scale
+
+    def literal(word):
+        nfa = NFA(alphabet)
+        nfa.build_from_string(word)
+        return nfa
+
+    def build():
+        nfa = literal('a')
+        for i in range(depth):
+            if i % 3 == 0:
+                nfa = nfa.star()
+            elif i % 3 == 1:
+                nfa = nfa | literal('b')
+            else:
+                nfa = nfa + literal('ca')
+        return nfa
+
+    nfa, result = construction(build, repeat)
+    rnd = random.Random(2)
+    result.update(match_rate(nfa, random_inputs(rnd, alphabet, 200, 32), repeat))
+    return result
+
+
+def bench_blowup(scale, repeat):
+    n = 6 + 2 * scale
+
+    def build():
+        nfa = NFA('ab')
+        nfa.build_from_regex('(a|b)*a(a|b){{{}}}'.format(n))
+        return nfa
+
+    nfa, result = construction(build, repeat)
+    rnd = random.Random(3)
+    result.update(match_rate(nfa, random_inputs(rnd, 'ab', 200, 64), repeat))
+
+    dfa, seconds = timed(nfa.subset_construct_dfa, repeat)
+    assert dfa.no_of_states >= 2 ** (n + 1)
+    result.update({
+        'n': n,
+        'dfa_states': dfa.no_of_states,
+        'dfa_seconds': seconds,
+        'dfa_states_per_sec': dfa.no_of_states / seconds,
+        'dfa_peak_bytes': peak_memory(nfa.subset_construct_dfa),
+    })
+    return result
+
+
+def bench_random(scale, repeat):
+    alphabet = 'abcd'
+    no_of_states = 1000 * scale
+    rnd = random.Random(4)
+    edges = []
+    for p in range(no_of_states):
+        for _ in range(3):
+            edges.append((p, rnd.choice(alphabet), rnd.randrange(no_of_states)))
+        if rnd.random() < 0.1:
+            edges.append((p, Epsilon, rnd.randrange(no_of_states)))
+    finals = set(rnd.sample(range(no_of_states), no_of_states // 20))
+
+    def build():
+        nfa = NFA(alphabet)
+        for p in range(no_of_states):
+            nfa.new_state(initial=(p == 0), final=(p in finals))
+        for p, sym, q in edges:
+            nfa.new_edge(p, sym, q)
+        return nfa
+
+    nfa, result = construction(build, repeat)
+    result['edges'] = len(edges)
+    result.update(match_rate(nfa, random_inputs(rnd, alphabet, 50, 64), repeat))
+    return result
+
+
+WORKLOADS = [
+    ('literals', bench_literals),
+    ('compositions', bench_compositions),
+    ('blowup', bench_blowup),
+    ('random', bench_random),
+]
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def compare(old, new):
+    """
+    Print the ratio new/old of every throughput and memory metric present in both runs
+    """
+    print('{:<14} {:<20} {:>14} {:>14} {:>8}'.format('workload', 'metric', 'old', 'new', 'ratio'))
+    for name, metrics in new['workloads'].items():
+        old_metrics = old['workloads'].get(name, {})
+        for metric, value in sorted(metrics.items()):
+            if not (metric.endswith('_per_sec') or metric.endswith('_bytes')) or metric not in old_metrics:
+                continue
+            print('{:<14} {:<20} {:>14.0f} {:>14.0f} {:>8.2f}'.format(
+                name, metric, old_metrics[metric], value, value / old_metrics[metric]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='pynfa benchmark suite')
+    parser.add_argument('--scale', type=int, default=2, help='size factor of the generated workloads')
+    parser.add_argument('--repeat', type=int, default=3, help='timings are the best of this many runs')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('workloads', nargs='*', help='workloads to run, default all')
+    args = parser.parse_args(argv[1:])
+
+    selected = args.workloads or [name for name, _ in WORKLOADS]
+    unknown = set(selected) - set(name for name, _ in WORKLOADS)
+    if unknown:
+        parser.error('unknown workloads: {}'.format(', '.join(sorted(unknown))))
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'workloads': {},
+    }
+    for name, bench in WORKLOADS:
+        if name in selected:
+            results['workloads'][name] = bench(args.scale, args.repeat)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    elif not args.compare:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -18,6 +18,21 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from time import perf_counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # only needed by CompiledDFA.accepts_batch
+
 
 class Epsilon:
     """Null symbol used for epsilon transitions"""
@@ -32,20 +47,737 @@ class NFAInvalidInput(NFAException):
     pass
 
 
+class NFASyntaxError(NFAException):
+    pass
+
+
+def _sorted_symbols(symbols):
+    """
+    Sort symbols for a stable iteration order, falling back to
+    ordering by repr() for alphabets of mixed types.
+    """
+    try:
+        return sorted(symbols)
+    except TypeError:
+        return sorted(symbols, key=repr)
+
+
+# Version of the binary formats written by NFA.save and CompiledDFA.save
+_FORMAT_VERSION = 1
+
+
+def _pack_values(values):
+    """
+    Serialize a list of symbols, names or tags. Supported values are
+    Epsilon, None, int, str and bytes.
+
+    :return: bytes
+    """
+    parts = [struct.pack('<I', len(values))]
+    for v in values:
+        if v is Epsilon:
+            parts.append(b'e')
+        elif v is None:
+            parts.append(b'n')
+        elif isinstance(v, int) and not isinstance(v, bool):
+            parts.append(b'i' + struct.pack('<q', v))
+        elif isinstance(v, (str, bytes)):
+            data = v.encode('utf-8') if isinstance(v, str) else v
+            parts.append((b's' if isinstance(v, str) else b'b') + struct.pack('<I', len(data)) + data)
+        else:
+            raise NFAException("can not serialize value {!r}".format(v))
+    return b''.join(parts)
+
+
+def _unpack_values(buf, offset):
+    """
+    Read a list written by _pack_values
+
+    :return: Tuple (list of values, offset after the list)
+    """
+    count, = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    values = []
+    for _ in range(count):
+        kind = buf[offset:offset + 1]
+        offset += 1
+        if kind == b'e':
+            values.append(Epsilon)
+        elif kind == b'n':
+            values.append(None)
+        elif kind == b'i':
+            values.append(struct.unpack_from('<q', buf, offset)[0])
+            offset += 8
+        elif kind in (b's', b'b'):
+            length, = struct.unpack_from('<I', buf, offset)
+            data = bytes(buf[offset + 4:offset + 4 + length])
+            values.append(data.decode('utf-8') if kind == b's' else data)
+            offset += 4 + length
+        else:
+            raise NFAException("corrupt value table at offset {}".format(offset - 1))
+    return values, offset
+
+
+def _pack_ints(values):
+    return struct.pack('<I', len(values)) + struct.pack('<{}i'.format(len(values)), *values)
+
+
+def _unpack_ints(buf, offset):
+    count, = struct.unpack_from('<I', buf, offset)
+    values = struct.unpack_from('<{}i'.format(count), buf, offset + 4)
+    return list(values), offset + 4 + 4 * count
+
+
+def _check_header(buf, magic):
+    if bytes(buf[:4]) != magic:
+        raise NFAException("not a {} file".format(magic.decode('ascii')))
+    version, = struct.unpack_from('<H', buf, 4)
+    if version != _FORMAT_VERSION:
+        raise NFAException("unsupported file format version {}".format(version))
+    return 6
+
+
+# Tags reported for a final state that has no tags of its own
+_UNTAGGED = frozenset([None])
+
+# Largest NFA that test_input and match_many run on _BitsetTables. The tables
+# take memory quadratic in the number of states, so bigger NFAs step sets of
+# states through the closure table instead.
+_BITSET_MAX_STATES = 4096
+
+
+class _BitsetTables(object):
+    """
+    Bitmask form of an NFA used on the matching hot path.
+
+    Each state id is given a bit position and a set of states is a
+    Python int with one bit set per member state. For every symbol
+    class there is a row holding, per bit position, the mask of the
+    epsilon closed states reached from that state over the symbols of
+    the class, and all symbols of a class share its row. Since the
+    current state set is always epsilon closed, stepping is an OR of
+    the rows for its members.
+
+    Every row holds one mask per state, so the tables take memory
+    quadratic in the number of states, see _BITSET_MAX_STATES.
+    """
+
+    def __init__(self, nfa):
+        closures = None if nfa.is_epsilon_free() else nfa._epsilon_closures()
+        states = sorted(nfa._states)
+        bits = {p: 1 << i for i, p in enumerate(states)}
+
+        if nfa.is_epsilon_free():
+            closure_masks = bits
+        else:
+            closure_masks = {}
+            for p in states:
+                mask = 0
+                for q in closures[p]:
+                    mask |= bits[q]
+                closure_masks[p] = mask
+
+        class_of, classes = nfa._classes()
+        representatives = {members[0]: c for c, members in enumerate(classes)}
+        representatives[Epsilon] = len(classes)
+        empty_row = [0] * len(states)
+        rows = [empty_row] * (len(classes) + 1)
+        for i, p in enumerate(states):
+            for sym, targets in nfa._states[p].items():
+                c = representatives.get(sym)
+                if c is None or not targets:
+                    continue
+                if rows[c] is empty_row:
+                    rows[c] = [0] * len(states)
+                mask = 0
+                for q in targets:
+                    mask |= closure_masks[q]
+                rows[c][i] = mask
+
+        self.class_of = class_of
+        self.class_rows = rows[:-1]  # [[mask per bit position] per class]
+        self.delta = {sym: rows[c] for sym, c in class_of.items()}  # {symbol:[mask per bit position]}
+        self.delta[Epsilon] = rows[-1]
+
+        self.states = states
+        self.bits = bits
+        self.closures = [closure_masks[p] for p in states]
+        self.initial = closure_masks.get(nfa._initial, 0)
+        self.finals = self.to_mask(nfa._finals)
+        self.tags = {bits[p].bit_length() - 1: frozenset(tags) for p, tags in nfa._tags.items()}
+        self.tag_order = nfa._tag_order
+        self.live = None  # bitmask of the states that can reach a final state, see NFA._live_mask
+
+    def to_mask(self, states):
+        """
+        :param states: Iterable of state ids
+        :return: Bitmask with the bits of all given states set
+        """
+        mask = 0
+        for p in states:
+            mask |= self.bits[p]
+        return mask
+
+    def to_set(self, mask):
+        """
+        :param mask: Bitmask of states
+        :return: Set of the state ids in mask
+        """
+        states = set()
+        while mask:
+            low = mask & -mask
+            states.add(self.states[low.bit_length() - 1])
+            mask ^= low
+        return states
+
+    def tags_of(self, mask):
+        """
+        :param mask: Bitmask of states
+        :return: Set of the tags of all final states in mask, with None for untagged ones
+        """
+        tags = set()
+        mask &= self.finals
+        while mask:
+            low = mask & -mask
+            tags |= self.tags.get(low.bit_length() - 1, _UNTAGGED)
+            mask ^= low
+        return tags
+
+    def row(self, sym):
+        """
+        Get the transition row of a symbol
+
+        Passing a symbol that is not part of the defined alphabet
+        throws NFAInvalidInput.
+        """
+        try:
+            return self.delta[sym]
+        except KeyError:
+            raise NFAInvalidInput("symbol {} not in the defined alphabet".format(sym))
+
+    def step(self, mask, sym):
+        """
+        :param mask: Epsilon closed bitmask of current states
+        :param sym: Input symbol
+        :return: Epsilon closed bitmask of next states
+        """
+        row = self.row(sym)
+        next_mask = 0
+        while mask:
+            low = mask & -mask
+            next_mask |= row[low.bit_length() - 1]
+            mask ^= low
+        return next_mask
+
+    def accepts(self, input_sequence):
+        """
+        Run the tables from the initial state over an input sequence
+
+        :param input_sequence: Iterable of input symbols
+        :return: True if the sequence ends in a final state
+        """
+        current = self.initial
+        delta = self.delta
+        for sym in input_sequence:
+            try:
+                row = delta[sym]
+            except KeyError:
+                raise NFAInvalidInput("symbol {} not in the defined alphabet".format(sym))
+            mask = current
+            current = 0
+            while mask:
+                low = mask & -mask
+                current |= row[low.bit_length() - 1]
+                mask ^= low
+            if not current:
+                return False
+
+        return True if current & self.finals else False
+
+    def accepts_many(self, input_sequences):
+        """
+        Run the tables over each of a number of input sequences,
+        with all lookups of the tables themselves done once
+
+        :param input_sequences: Iterable of input sequences
+        :return: Generator of True/False per input sequence
+        """
+        initial = self.initial
+        finals = self.finals
+        delta = self.delta
+        for input_sequence in input_sequences:
+            current = initial
+            for sym in input_sequence:
+                try:
+                    row = delta[sym]
+                except KeyError:
+                    raise NFAInvalidInput("symbol {} not in the defined alphabet".format(sym))
+                mask = current
+                current = 0
+                while mask:
+                    low = mask & -mask
+                    current |= row[low.bit_length() - 1]
+                    mask ^= low
+                if not current:
+                    break
+            yield True if current & finals else False
+
+
+class _LazyDFA(object):
+    """
+    DFA built on the fly from the bitmask tables of an NFA.
+
+    A DFA state is the bitmask of an epsilon closed NFA state set, and
+    each (state set, symbol class) transition is computed the first time
+    an input reaches it and then kept in a bounded cache.
+
+    When the cache is full an entry is evicted, either the least recently
+    used one ('lru') or the whole cache at once ('flush'). If a window of
+    cache_size lookups sees both evictions and a miss ratio above
+    thrash_ratio, the cache is bypassed for the next window and inputs
+    are matched by plain bitmask simulation.
+    """
+
+    EVICTION_POLICIES = ('lru', 'flush')
+
+    def __init__(self, tables, cache_size, eviction='lru', thrash_ratio=0.5):
+        self.tables = tables
+        self.cache_size = cache_size
+        self.eviction = eviction
+        self.thrash_ratio = thrash_ratio
+        self.cache = OrderedDict()  # {(bitmask, symbol class):bitmask}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._window = 0
+        self._window_misses = 0
+        self._window_evictions = 0
+        self._bypass = 0
+
+    def _store(self, key, value):
+        cache = self.cache
+        if len(cache) >= self.cache_size:
+            if self.eviction == 'lru':
+                cache.popitem(last=False)
+                self.evictions += 1
+                self._window_evictions += 1
+            else:
+                self.evictions += len(cache)
+                self._window_evictions += len(cache)
+                cache.clear()
+        cache[key] = value
+
+    def _end_window(self):
+        if self._window_evictions and self._window_misses > self.thrash_ratio * self._window:
+            self._bypass = self.cache_size
+        self._window = 0
+        self._window_misses = 0
+        self._window_evictions = 0
+
+    def step(self, mask, sym):
+        """
+        :param mask: Epsilon closed bitmask of current states
+        :param sym: Input symbol
+        :return: Epsilon closed bitmask of next states
+        """
+        if self._bypass:
+            self._bypass -= 1
+            return self.tables.step(mask, sym)
+
+        c = self.tables.class_of.get(sym)
+        if c is None:
+            return self.tables.step(mask, sym)
+
+        key = (mask, c)
+        try:
+            next_mask = self.cache[key]
+        except KeyError:
+            next_mask = self.tables.step(mask, sym)
+            self.misses += 1
+            self._window_misses += 1
+            self._store(key, next_mask)
+        else:
+            self.hits += 1
+            if self.eviction == 'lru':
+                self.cache.move_to_end(key)
+
+        self._window += 1
+        if self._window >= self.cache_size:
+            self._end_window()
+        return next_mask
+
+    def accepts(self, input_sequence):
+        """
+        Run the lazy DFA from the initial state over an input sequence
+
+        :param input_sequence: Iterable of input symbols
+        :return: True if the sequence ends in a final state
+        """
+        current = self.tables.initial
+        step = self.step
+        for sym in input_sequence:
+            current = step(current, sym)
+            if not current:
+                return False
+
+        return True if current & self.tables.finals else False
+
+    def accepts_many(self, input_sequences):
+        """
+        :param input_sequences: Iterable of input sequences
+        :return: Generator of True/False per input sequence
+        """
+        accepts = self.accepts
+        for input_sequence in input_sequences:
+            yield accepts(input_sequence)
+
+
+class MatchStats(object):
+    """
+    Counters and timers filled in by an NFA while instrumentation is on,
+    see NFA.enable_stats.
+
+    counters: {name: count}. test_input counts 'inputs' and 'symbols',
+        move 'moves', closure 'closures', building the closure table
+        'closure_iterations' (states expanded), subset_construct_dfa
+        'dfa_states' and 'subset_moves'. Lookups of the closure and
+        matching tables count as 'cache_hits' or 'cache_misses', and
+        lazy DFA transitions as 'dfa_cache_hits' or 'dfa_cache_misses'.
+    times: {phase: seconds} for the phases 'tables', 'match', 'move',
+        'closure' and 'subset_construction'.
+    active_sizes: {size: count}, histogram of the sizes of the active
+        state sets seen by test_input and move.
+    max_active: Largest active state set seen.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Set all counters and timers back to zero
+        """
+        self.counters = {}
+        self.times = {}
+        self.active_sizes = {}
+        self.max_active = 0
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+    def active(self, size):
+        self.active_sizes[size] = self.active_sizes.get(size, 0) + 1
+        if size > self.max_active:
+            self.max_active = size
+
+    def snapshot(self):
+        """
+        :return: Dict with copies of the current counters, times, active_sizes and max_active
+        """
+        return {
+            'counters': dict(self.counters),
+            'times': dict(self.times),
+            'active_sizes': dict(self.active_sizes),
+            'max_active': self.max_active,
+        }
+
+
+class CheckResult(object):
+    """
+    Outcome of a language check like NFA.is_empty or NFA.is_equivalent.
+    True or False in a boolean context, and when the check failed the
+    counterexample attribute holds an input sequence showing why.
+    """
+
+    def __init__(self, result, counterexample=None):
+        self.result = result
+        self.counterexample = counterexample  # list of symbols, or None if the check held
+
+    def __bool__(self):
+        return self.result
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "CheckResult({}, counterexample={!r})".format(self.result, self.counterexample)
+
+
+def _first_tag(tags, order):
+    """
+    :param tags: Set of tags, with None for untagged final states
+    :param order: Dict of format {tag: position}, e.g. pattern positions recorded by tagged_union
+    :return: The tag other than None with the lowest position in order, the lowest tag if
+             none of them has a position, or None if there is no tag
+    """
+    tags = [t for t in tags if t is not None]
+    ranked = [t for t in tags if t in order]
+    if ranked:
+        return min(ranked, key=order.get)
+    return _sorted_symbols(tags)[0] if tags else None
+
+
+def _trace(parents, key):
+    """
+    Follow parent links from key back to a root
+
+    :param parents: Dict of format {key: (parent key, symbol)}, with None for roots
+    :return: List of the symbols on the path from the root to key
+    """
+    symbols = []
+    link = parents[key]
+    while link is not None:
+        key, sym = link
+        symbols.append(sym)
+        link = parents[key]
+    symbols.reverse()
+    return symbols
+
+
+class _RegexParser(object):
+    """
+    Recursive descent parser turning a regular expression into a tree of tuples:
+
+      ('sym', frozenset(symbols))  one symbol out of a set
+      ('cat', [nodes])             concatenation, empty for the empty string
+      ('alt', [nodes])             alternation
+      ('rep', node, m, n)          node repeated m to n times, n is None for no limit
+
+    Supported syntax is literals, '.', character classes like [a-z] and [^0-9],
+    grouping with (), alternation with |, the operators *, + and ?, bounded
+    repetition with {m}, {m,} and {m,n}, and escaping of any character with \\.
+    """
+
+    METACHARS = set('|()[]{}*+?.\\')
+
+    def __init__(self, pattern, alphabet):
+        self.pattern = pattern
+        self.alphabet = alphabet
+        self.pos = 0
+
+    def error(self, message):
+        return NFASyntaxError("{} at position {} in pattern {!r}".format(message, self.pos, self.pattern))
+
+    def peek(self):
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def take(self):
+        c = self.peek()
+        if c is None:
+            raise self.error("unexpected end of pattern")
+        self.pos += 1
+        return c
+
+    def literal(self, c):
+        if c not in self.alphabet:
+            raise NFAInvalidInput("symbol {} not in the defined alphabet".format(c))
+        return c
+
+    def parse(self):
+        node = self.alternation()
+        if self.peek() is not None:
+            raise self.error("unbalanced parenthesis")
+        return node
+
+    def alternation(self):
+        branches = [self.concatenation()]
+        while self.peek() == '|':
+            self.pos += 1
+            branches.append(self.concatenation())
+        return branches[0] if len(branches) == 1 else ('alt', branches)
+
+    def concatenation(self):
+        items = []
+        while self.peek() not in (None, '|', ')'):
+            items.append(self.repetition())
+        return items[0] if len(items) == 1 else ('cat', items)
+
+    def repetition(self):
+        node = self.atom()
+        while True:
+            c = self.peek()
+            if c == '*':
+                node = ('rep', node, 0, None)
+            elif c == '+':
+                node = ('rep', node, 1, None)
+            elif c == '?':
+                node = ('rep', node, 0, 1)
+            elif c == '{':
+                self.pos += 1
+                m, n = self.bounds()
+                node = ('rep', node, m, n)
+                continue
+            else:
+                return node
+            self.pos += 1
+
+    def number(self):
+        start = self.pos
+        while self.peek() is not None and self.peek().isdigit():
+            self.pos += 1
+        return int(self.pattern[start:self.pos]) if self.pos > start else None
+
+    def bounds(self):
+        m = self.number()
+        if m is None:
+            raise self.error("expected repetition count")
+        n = m
+        if self.peek() == ',':
+            self.pos += 1
+            n = self.number()
+        if self.take() != '}':
+            raise self.error("expected }")
+        if n is not None and n < m:
+            raise self.error("bad repetition range {{{},{}}}".format(m, n))
+        return m, n
+
+    def atom(self):
+        c = self.take()
+        if c == '(':
+            node = self.alternation()
+            if self.take() != ')':
+                raise self.error("expected )")
+            return node
+        elif c == '[':
+            return ('sym', self.char_class())
+        elif c == '.':
+            return ('sym', frozenset(self.alphabet))
+        elif c == '\\':
+            return ('sym', frozenset([self.literal(self.take())]))
+        elif c in self.METACHARS:
+            raise self.error("unexpected {}".format(c))
+        return ('sym', frozenset([self.literal(c)]))
+
+    def char_class(self):
+        negate = self.peek() == '^'
+        if negate:
+            self.pos += 1
+
+        symbols = set()
+        first = True
+        while first or self.peek() != ']':
+            first = False
+            c = self.take()
+            if c == '\\':
+                c = self.take()
+            if self.peek() == '-' and self.pos + 1 < len(self.pattern) and self.pattern[self.pos + 1] != ']':
+                self.pos += 1
+                end = self.take()
+                if end == '\\':
+                    end = self.take()
+                if ord(end) < ord(c):
+                    raise self.error("bad character range {}-{}".format(c, end))
+                # Ranges are limited to the symbols in the alphabet
+                symbols.update(chr(i) for i in range(ord(c), ord(end) + 1) if chr(i) in self.alphabet)
+            else:
+                symbols.add(self.literal(c))
+        self.pos += 1
+
+        return frozenset(self.alphabet - symbols if negate else symbols)
+
+
+# Parsed regular expressions by (pattern, alphabet), see compile_regex
+_regex_cache = {}
+_REGEX_CACHE_SIZE = 256
+
+
+def compile_regex(pattern, alphabet, sparse=False):
+    """
+    Compile a regular expression to an NFA accepting exactly the strings it matches.
+
+    Parsed patterns are cached by pattern and alphabet, so compiling the same
+    pattern again skips the parsing. Every call returns a new NFA instance
+    of its own, which the caller is free to modify.
+
+    Example:
+       nfa = compile_regex('[+-]?[0-9]+', '0123456789+-')
+       nfa.test_input('-12')
+
+    :param pattern: Regular expression, see NFA.build_from_regex for the syntax
+    :param alphabet: Sequence of symbols making up the input alphabet
+    :param sparse: If True, use the sparse transition layout
+    :return: NFA instance
+    """
+    key = (pattern, frozenset(alphabet))
+    tree = _regex_cache.get(key)
+    if tree is None:
+        tree = _RegexParser(pattern, set(alphabet)).parse()
+        if len(_regex_cache) >= _REGEX_CACHE_SIZE:
+            _regex_cache.clear()
+        _regex_cache[key] = tree
+
+    nfa = NFA(alphabet, sparse=sparse)
+    nfa._build_from_regex_tree(tree)
+    return nfa
+
+
+# Matcher of the current worker process, set up once by _parallel_init
+_worker_matcher = None
+
+
+def _parallel_init(matcher):
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _parallel_match(chunk):
+    return array('B', _worker_matcher.accepts_many(chunk))
+
+
+def _parallel_matches(matcher, input_sequences, workers, chunk_size):
+    """
+    Match chunks of input sequences in a pool of worker processes.
+
+    The matcher is sent to each worker once, when the worker starts.
+    At most two chunks per worker are in flight at any time, and results
+    are yielded in input order as soon as the chunk holding them is done.
+    """
+    workers = workers or os.cpu_count() or 1
+    sequences = iter(input_sequences)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_parallel_init, initargs=(matcher,)) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(islice(sequences, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.submit(_parallel_match, chunk))
+            if not pending:
+                break
+            for result in pending.popleft().result():
+                yield result == 1
+
+
 class NFA(object):
 
-    def __init__(self, alphabet):
+    def __init__(self, alphabet, sparse=False):
         """
         :param alphabet: Sequence of symbols making up the input alphabet
+        :param sparse: If True, states only store the symbols they have edges on,
+                       instead of one (possibly empty) set per alphabet symbol
         :return: None
         """
         self._alphabet = set(alphabet)
+        self._sparse = sparse
         self._states = {}  # {state:{symbol:set(states)}}
         self._state_names = {}
         self._finals = set()
+        self._tags = {}  # {final state:set(tags)}
+        self._tag_order = {}  # {tag:position}, pattern order of a tagged_union
         self._initial = None
         self._next_state = 0
         self._alphabet.add(Epsilon)
+        self._predecessors = None  # {state:{predecessor:set(symbols)}}, built on demand
+        self._sources = None  # {symbol:set(states)}, states with edges on symbol, built with _predecessors
+        self._epsilon_free = None  # cached result of is_epsilon_free()
+        self._closure_table = None  # {state:frozenset(states)}, built on demand
+        self._symbol_class_table = None  # ({symbol:class}, [[symbols]]), built on demand
+        self._bitset_tables = None  # _BitsetTables, built on demand
+        self._lazy_dfa_options = None  # (cache_size, eviction) when lazy matching is on
+        self._lazy_dfa = None  # _LazyDFA, built on demand
+        self._stats = None  # MatchStats while instrumentation is on
 
     def new_state(self, initial=False, final=False, name=None):
         """
@@ -57,8 +789,9 @@ class NFA(object):
         """
         sid = self._next_state
         self._next_state += 1
-        self._states[sid] = {s: set() for s in self._alphabet}
+        self._states[sid] = {} if self._sparse else {s: set() for s in self._alphabet}
         self._state_names[sid] = name or str(sid)
+        self._invalidate_caches()
         if final:
             self._finals.add(sid)
 
@@ -77,17 +810,32 @@ class NFA(object):
         """
         prev = self._initial
         self._initial = sid
+        self._invalidate_caches()
 
         return prev
 
-    def set_as_final_state(self, sid):
+    def set_as_final_state(self, sid, tag=None):
         """
         Add state sid as an accepting final state
 
         :param sid: State id to be added to final state set
+        :param tag: Optional tag, e.g. a pattern id, reported when input is accepted in sid.
+                    A final state may have several tags.
         :return: None
         """
         self._finals.add(sid)
+        if tag is not None:
+            self._tags.setdefault(sid, set()).add(tag)
+        self._invalidate_caches()
+
+    def get_tags(self, sid):
+        """
+        Get the tags of a final state
+
+        :param sid: State id
+        :return: Set of tags, empty if the state has none
+        """
+        return set(self._tags.get(sid, ()))
 
     def remove_final_state(self, sid):
         """
@@ -97,6 +845,8 @@ class NFA(object):
         :return: None
         """
         self._finals.remove(sid)
+        self._tags.pop(sid, None)
+        self._invalidate_caches()
 
     def del_state(self, sid):
         """
@@ -104,24 +854,305 @@ class NFA(object):
         Any transitions to the deleted state from other states
         are removed as well
         """
-        for p in self._states:
-            for sym, states in self._states[p].items():
-                if sid in states:
-                    self._states[p][sym].remove(sid)
+        self._remove_state(sid)
+        self._invalidate_caches()
+
+    def del_states(self, sids):
+        """
+        Delete a number of states from the NFA, like del_state.
+        The cost is proportional to the number of edges to and from
+        the deleted states.
+
+        :param sids: Iterable of state ids
+        :return: None
+        """
+        for sid in sids:
+            self._remove_state(sid)
+        self._invalidate_caches()
+
+    def _remove_state(self, sid):
+        """
+        Delete a state and all edges to and from it, using the reverse index
+        to find the edges to it
+        """
+        predecessors, sources = self._reverse_index()
+        edges = self._states.pop(sid)
+
+        # Remove edges to sid
+        for p, syms in predecessors.pop(sid, {}).items():
+            if p == sid:
+                continue
+            for sym in syms:
+                states = self._states[p][sym]
+                states.discard(sid)
+                if not states:
+                    sources[sym].discard(p)
+                    if self._sparse:
+                        del self._states[p][sym]
+
+        # Remove edges from sid
+        for sym, states in edges.items():
+            if states:
+                sources[sym].discard(sid)
+            for q in states:
+                if q != sid:
+                    predecessors[q].pop(sid, None)
 
         if self._initial == sid:
             self._initial = None
 
         if sid in self._finals:
             self._finals.remove(sid)
+            self._tags.pop(sid, None)
 
-        del self._states[sid]
         del self._state_names[sid]
 
+    def _invalidate_caches(self):
+        """
+        Drop all tables derived from the transition function.
+        Called whenever states or edges are added or removed.
+        """
+        self._epsilon_free = None
+        self._closure_table = None
+        self._symbol_class_table = None
+        self._bitset_tables = None
+        self._lazy_dfa = None
+
+    def _epsilon_closures(self):
+        """
+        Get the epsilon closure table, building it first if needed.
+
+        The closure of a state that is already in the table is reused
+        as a whole instead of being traversed again.
+
+        :return: Dict mapping each state id to the frozenset of its closure
+        """
+        if self._closure_table is None and self.is_epsilon_free():
+            self._closure_table = {p: frozenset((p,)) for p in self._states}
+
+        if self._closure_table is None:
+            table = {}
+            iterations = 0
+            for p in self._states:
+                closure_states = {p}
+                stack = [p]
+                while stack:
+                    iterations += 1
+                    for q in self._states[stack.pop()].get(Epsilon, ()):
+                        if q in closure_states:
+                            continue
+                        done = table.get(q)
+                        if done is not None:
+                            closure_states |= done
+                        else:
+                            closure_states.add(q)
+                            stack.append(q)
+                table[p] = frozenset(closure_states)
+            self._closure_table = table
+            if self._stats is not None:
+                self._stats.count('closure_iterations', iterations)
+
+        return self._closure_table
+
+    def _classes(self):
+        """
+        Get the symbol class table, building it first if needed.
+
+        :return: Tuple ({symbol: class id}, [[symbols] per class id])
+        """
+        if self._symbol_class_table is None:
+            # Two symbols are equivalent if every state has the same edges on both
+            signatures = {}
+            for p, edges in self._states.items():
+                for sym, states in edges.items():
+                    if states and sym is not Epsilon:
+                        signatures.setdefault(sym, []).append((p, frozenset(states)))
+
+            class_ids = {}
+            class_of = {}
+            classes = []
+            for sym in _sorted_symbols(self._alphabet - {Epsilon}):
+                signature = frozenset(signatures.get(sym, ()))
+                c = class_ids.get(signature)
+                if c is None:
+                    c = class_ids[signature] = len(classes)
+                    classes.append([])
+                classes[c].append(sym)
+                class_of[sym] = c
+            self._symbol_class_table = (class_of, classes)
+
+        return self._symbol_class_table
+
+    def symbol_classes(self):
+        """
+        Group the alphabet into equivalence classes of symbols that no
+        transition of this NFA distinguishes, i.e. every state has the
+        same edges on all symbols of a class. Symbols without any edges
+        form one class.
+
+        Example:
+           nfa = compile_regex('[0-9]+x', '0123456789xyz')
+           nfa.symbol_classes()  -> ({'0': 0, ..., '9': 0, 'x': 1, 'y': 2, 'z': 2},
+                                     [['0', ..., '9'], ['x'], ['y', 'z']])
+
+        :return: Tuple (dict mapping each symbol to a class id, list of the symbols of each class id)
+        """
+        class_of, classes = self._classes()
+        return dict(class_of), [list(members) for members in classes]
+
+    def _bitsets(self):
+        """
+        Get the bitmask tables used for matching, building them first if needed.
+
+        :return: _BitsetTables instance for the current NFA
+        """
+        if self._bitset_tables is None:
+            self._bitset_tables = _BitsetTables(self)
+
+        return self._bitset_tables
+
+    def _lazy(self):
+        """
+        Get the lazily built DFA used for matching, creating it first if needed.
+
+        :return: _LazyDFA instance for the current NFA
+        """
+        if self._lazy_dfa is None:
+            cache_size, eviction = self._lazy_dfa_options
+            self._lazy_dfa = _LazyDFA(self._bitsets(), cache_size, eviction)
+
+        return self._lazy_dfa
+
+    def enable_stats(self):
+        """
+        Start recording counters and timers for test_input, move, closure
+        and subset_construct_dfa. While instrumentation is off the only cost
+        is one check per call; per symbol loops are left untouched.
+        Instrumented calls run a slower, counting version of the matching loop.
+
+        Example:
+          stats = nfa.enable_stats()
+          nfa.test_input('0110')
+          stats.snapshot()  -> {'counters': {'inputs': 1, 'symbols': 4, ...}, ...}
+
+        :return: MatchStats instance that is filled in, kept across calls until disabled
+        """
+        if self._stats is None:
+            self._stats = MatchStats()
+        return self._stats
+
+    def disable_stats(self):
+        """
+        Stop recording counters and timers
+        """
+        self._stats = None
+
+    @property
+    def stats(self):
+        """
+        MatchStats instance being filled in, or None if instrumentation is off
+        """
+        return self._stats
+
+    def _profiled_table(self, name, build):
+        """
+        Fetch a derived table through build(), counting a cache hit if the
+        attribute name already holds it and timing the build otherwise
+        """
+        stats = self._stats
+        if getattr(self, name) is not None:
+            stats.count('cache_hits')
+            return build()
+
+        stats.count('cache_misses')
+        start = perf_counter()
+        table = build()
+        stats.add_time('tables', perf_counter() - start)
+        return table
+
+    def enable_lazy_dfa(self, cache_size=10000, eviction='lru'):
+        """
+        Make test_input build DFA states on the fly as inputs reach them.
+
+        Each (state set, symbol) transition that is computed is kept in a cache
+        of at most cache_size entries. If the cache thrashes, matching falls back
+        to plain simulation until the hit rate recovers. The cache is emptied
+        when the NFA is modified.
+
+        :param cache_size: Max number of cached transitions
+        :param eviction: 'lru' to evict the least recently used transition,
+                         'flush' to empty the whole cache when it is full
+        :return: None
+        """
+        if eviction not in _LazyDFA.EVICTION_POLICIES:
+            raise NFAException("unknown eviction policy {}".format(eviction))
+        if cache_size < 1:
+            raise NFAException("cache size must be at least 1")
+
+        self._lazy_dfa_options = (cache_size, eviction)
+        self._lazy_dfa = None
+
+    def disable_lazy_dfa(self):
+        """
+        Make test_input go back to plain simulation and drop the lazy DFA cache.
+        """
+        self._lazy_dfa_options = None
+        self._lazy_dfa = None
+
     @property
     def no_of_states(self):
         return len(self._states)
 
+    @property
+    def sparse(self):
+        return self._sparse
+
+    def _add_edges(self, p, s, states):
+        """
+        Add edges from state p over symbol s to each of states, keeping the
+        reverse index up to date if it has been built. Callers are responsible
+        for calling _invalidate_caches.
+
+        Passing a symbol that is not part of the defined alphabet
+        throws NFAInvalidInput.
+        """
+        edges = self._states[p]
+        targets = edges.get(s)
+        if targets is None:
+            if s not in self._alphabet:
+                raise NFAInvalidInput("symbol {} not in the defined alphabet".format(s))
+            if not states:
+                return
+            targets = edges[s] = set()
+        targets.update(states)
+
+        if self._predecessors is not None and states:
+            for q in states:
+                self._predecessors.setdefault(q, {}).setdefault(p, set()).add(s)
+            self._sources.setdefault(s, set()).add(p)
+
+    def _reverse_index(self):
+        """
+        Get the reverse index of the transition function, building it first
+        if needed. Once built it is kept up to date as edges are added and
+        states deleted.
+
+        :return: Tuple ({state: {predecessor: set(symbols)}}, {symbol: set(states with edges on symbol)})
+        """
+        if self._predecessors is None:
+            predecessors = {p: {} for p in self._states}
+            sources = {}
+            for p, edges in self._states.items():
+                for sym, states in edges.items():
+                    if states:
+                        sources.setdefault(sym, set()).add(p)
+                        for q in states:
+                            predecessors.setdefault(q, {}).setdefault(p, set()).add(sym)
+            self._predecessors = predecessors
+            self._sources = sources
+
+        return self._predecessors, self._sources
+
     def delta(self, state, symbol):
         """
         Determine next set of states given current state
@@ -135,6 +1166,8 @@ class NFA(object):
         except KeyError:
             if symbol not in self._alphabet:
                 raise NFAInvalidInput("symbol {} not in the defined alphabet".format(symbol))
+            elif self._sparse and state in self._states:
+                return set()
             else:
                 raise
 
@@ -147,7 +1180,8 @@ class NFA(object):
         :param q: Edge destination state id
         :return: None
         """
-        self._states[p][s].add(q)
+        self._add_edges(p, s, (q,))
+        self._invalidate_caches()
 
     def new_edge_set(self, p, s, states):
         """
@@ -158,7 +1192,8 @@ class NFA(object):
         :param states: Set of edge destination state ids
         :return: None
         """
-        self._states[p][s] |= states
+        self._add_edges(p, s, states)
+        self._invalidate_caches()
 
     def add_multiple_edges(self, p, state_map):
         """Add multiple state transitions from state p
@@ -169,24 +1204,22 @@ class NFA(object):
            Add one edge for each input symbol sym to its mapped state
         """
         for sym, state in state_map.items():
-            self._states[p][sym].add(state)
+            self._add_edges(p, sym, (state,))
+        self._invalidate_caches()
 
     def has_edge_on_symbol(self, p, s, q):
         """
         Check if there is an edge from state p
         over symbol s to state q
         """
-        return q in self._states[p][s]
+        return q in self.delta(p, s)
 
     def has_edge(self, p, q):
         """
         Check if there is an edge from state p
         to state q on any symbol
         """
-        for sym, states in self._states[p].items():
-            if q in states:
-                return True
-        return False
+        return p in self._reverse_index()[0].get(q, ())
 
     def get_states(self):
         """
@@ -215,6 +1248,9 @@ class NFA(object):
         Get a dict mapping all edges from state q
         of format {symbol: set(states), ...}
         """
+        if self._sparse:
+            edges = self._states[p]
+            return {s: edges.get(s) or set() for s in self._alphabet}
         return {s: q for s, q in self._states[p].items()}
 
     def get_edges_on_symbol(self, s):
@@ -222,18 +1258,11 @@ class NFA(object):
         Get a dict mapping all edges from state over symbol s
         of format {from_state: to_state, ...}
         """
-        edges = {}
-        for p, states in self._states.items():
-            try:
-                if states[s]:
-                    edges[p] = set([q for q in states[s]])
-            except KeyError:
-                if s not in self._alphabet:
-                    raise NFAInvalidInput("symbol {} not in the defined alphabet".format(s))
-                else:
-                    raise
+        if s not in self._alphabet:
+            raise NFAInvalidInput("symbol {} not in the defined alphabet".format(s))
 
-        return edges
+        sources = self._reverse_index()[1]
+        return {p: set(self._states[p][s]) for p in sources.get(s, ())}
 
     def move(self, s, sym):
         """
@@ -243,23 +1272,24 @@ class NFA(object):
         :param sym: input symbol
         :return: resulting state set
         """
-        current_states = s
-        processed = set()
-        while processed ^ current_states:
-            for p in list(processed ^ current_states):
-                current_states |= self.delta(p, Epsilon)
-                processed.add(p)
+        stats = self._stats
+        if stats is not None:
+            start = perf_counter()
 
         next_states = set()
-        for p in current_states:
-            next_states |= self.delta(p, sym)
-
-        processed = set()
-        while processed ^ next_states:
-            for p in list(processed ^ next_states):
-                next_states |= self.delta(p, Epsilon)
-                processed.add(p)
-
+        if self.is_epsilon_free():
+            for p in s:
+                next_states |= self.delta(p, sym)
+        else:
+            closures = self._epsilon_closures()
+            for p in self.closure(s):
+                for q in self.delta(p, sym):
+                    next_states |= closures[q]
+
+        if stats is not None:
+            stats.count('moves')
+            stats.active(len(next_states))
+            stats.add_time('move', perf_counter() - start)
         return next_states
 
     def test_input(self, input_sequence):
@@ -268,182 +1298,514 @@ class NFA(object):
         True if the whole sequence is consumed and the NFA is in
         at least one final state
 
+        NFAs of up to 4096 states are run on bitmask tables, whose memory
+        grows with the square of the number of states. Larger NFAs step
+        sets of states instead, which also ignores enable_lazy_dfa.
+
         :param input_sequence: Iterable of input symbols from the defined alphabet
         :returns: True if the NFA accepts input, False if not
         """
         if self._initial is None:
             raise NFAException("NFA has no initial state")
 
-        current_states = self.closure({self._initial})
+        if len(self._states) > _BITSET_MAX_STATES:
+            return self._test_input_sets(input_sequence)
+        if self._stats is not None:
+            return self._test_input_profiled(input_sequence)
+        if self._lazy_dfa_options is not None:
+            return self._lazy().accepts(input_sequence)
+        return self._bitsets().accepts(input_sequence)
+
+    def _test_input_profiled(self, input_sequence):
+        """
+        test_input, recording counters and timers in the stats object
+        """
+        stats = self._stats
+        lazy = self._lazy_dfa_options is not None
+        if lazy:
+            matcher = self._profiled_table('_lazy_dfa', self._lazy)
+            hits, misses = matcher.hits, matcher.misses
+        else:
+            matcher = self._profiled_table('_bitset_tables', self._bitsets)
+        tables = self._bitset_tables
+
+        start = perf_counter()
+        current = tables.initial
+        stats.active(bin(current).count('1'))
+        symbols = 0
         for sym in input_sequence:
-            current_states = self.move(current_states, sym)
-            if not current_states:
-                return False
+            current = matcher.step(current, sym)
+            symbols += 1
+            stats.active(bin(current).count('1'))
+            if not current:
+                break
+        stats.add_time('match', perf_counter() - start)
+
+        stats.count('inputs')
+        stats.count('symbols', symbols)
+        if lazy:
+            stats.count('dfa_cache_hits', matcher.hits - hits)
+            stats.count('dfa_cache_misses', matcher.misses - misses)
+        return True if current & tables.finals else False
+
+    def _test_input_sets(self, input_sequence):
+        """
+        test_input by stepping sets of states over the closure table, for
+        NFAs too large for the matching tables
+        """
+        closures = self._epsilon_closures()
+        states = self._states
+        current = closures[self._initial]
+        symbols = 0
+        for sym in input_sequence:
+            if sym not in self._alphabet:
+                raise NFAInvalidInput("symbol {} not in the defined alphabet".format(sym))
+            symbols += 1
+            next_states = set()
+            for p in current:
+                for q in states[p].get(sym, ()):
+                    next_states |= closures[q]
+            current = next_states
+            if not current:
+                break
+
+        if self._stats is not None:
+            self._stats.count('inputs')
+            self._stats.count('symbols', symbols)
+        return not self._finals.isdisjoint(current)
+
+    def match_many(self, input_sequences):
+        """
+        Run NFA on each of a number of input sequences, like test_input.
 
-        return True if current_states & self._finals else False
+        Setup that test_input does per call, like checking the initial state
+        and fetching the matching tables, is done once for the whole batch.
+        Results are produced lazily, so input_sequences may be a stream.
+        NFAs above the state limit of test_input step sets of states per input.
 
-    def __or__(self, other):
+        :param input_sequences: Iterable of input sequences
+        :return: Generator of True/False per input sequence
         """
-        Concatenate two NFAs
-        A new NFA is returned with the concatenated NFAs, leaving both input NFAs unchanged
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
 
-        Example:
-          combined_nfa = nfa1 | nfa2
+        if len(self._states) > _BITSET_MAX_STATES:
+            return (self._test_input_sets(v) for v in input_sequences)
+        if self._lazy_dfa_options is not None:
+            return self._lazy().accepts_many(input_sequences)
+        return self._bitsets().accepts_many(input_sequences)
 
-          combined_nfa will match any input string that is a matching
-          string from nfa1 concatenated with a matching string from nfa2
+    def test_inputs(self, input_sequences):
+        """
+        Run NFA on each of a number of input sequences, like test_input.
 
-        :param other: Other NFA to be concatenated after this one
-        :return: Concatenated new NFA
+        :param input_sequences: Iterable of input sequences
+        :return: array('B') holding 1 for each accepted and 0 for each rejected input
+        """
+        return array('B', self.match_many(input_sequences))
+
+    def matching_tags(self, input_sequence):
         """
-        concat = NFA(self._alphabet)
+        Run NFA on an input sequence of symbols and return the tags of
+        the final states it ends in, e.g. the ids of all patterns of a
+        tagged_union that match the input.
 
-        sid_first_to_new = {}
-        sid_new_to_first = {}
-        sid_second_to_new = {}
-        sid_new_to_second = {}
+        :param input_sequence: Iterable of input symbols from the defined alphabet
+        :return: Set of tags, with None for final states without tags. Empty if the input is rejected.
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
 
-        # Add all states from first NFA to new NFA
-        for p, name in self.get_states().items():
-            sid = concat.new_state(name=name)
-            sid_first_to_new[p] = sid
-            sid_new_to_first[sid] = p
+        tables = self._bitsets()
+        step = self._lazy().step if self._lazy_dfa_options is not None else tables.step
+        current = tables.initial
+        for sym in input_sequence:
+            current = step(current, sym)
+            if not current:
+                break
 
-        # Add all states from second NFA
-        for p, name in other.get_states().items():
-            sid = concat.new_state(name=name)
-            sid_second_to_new[p] = sid
-            sid_new_to_second[sid] = p
+        return tables.tags_of(current)
 
-        # Add all transitions from first NFA
-        for p in self.get_states():
-            for s, states in self.get_edges_from_state(p).items():
-                concat.new_edge_set(sid_first_to_new[p], s, set([sid_first_to_new[q] for q in states]))
+    def match_many_parallel(self, input_sequences, workers=None, chunk_size=1000):
+        """
+        Run NFA on each of a number of input sequences, like match_many,
+        but spread over a pool of worker processes.
+
+        The bitmask tables of the NFA are pickled and sent to each worker once.
+        Input sequences are then sent in chunks, so input_sequences may be a
+        stream, and results come back in input order. With the lazy DFA enabled
+        each worker keeps its own transition cache.
+
+        :param input_sequences: Iterable of picklable input sequences
+        :param workers: Number of worker processes, defaults to the number of CPUs
+        :param chunk_size: Number of input sequences sent to a worker at a time
+        :return: Generator of True/False per input sequence
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
 
-        # Add all transitions from second NFA
-        for p in other.get_states():
-            for s, states in other.get_edges_from_state(p).items():
-                concat.new_edge_set(sid_second_to_new[p], s, set([sid_second_to_new[q] for q in states]))
+        if self._lazy_dfa_options is not None:
+            cache_size, eviction = self._lazy_dfa_options
+            matcher = _LazyDFA(self._bitsets(), cache_size, eviction)
+        else:
+            matcher = self._bitsets()
+        return _parallel_matches(matcher, input_sequences, workers, chunk_size)
 
-        # Set first NFA start state as new start state
-        concat.set_initial_state(sid_first_to_new[self._initial])
+    def _absorb(self, other):
+        """
+        Add copies of all states and edges of another NFA to this one,
+        giving the copies new consecutive state ids. The initial state,
+        finals and tags of other are not copied.
 
-        # Connect all final states in first NFA to start state of second NFA
-        for p in self.get_finals():
-            concat.new_edge(sid_first_to_new[p], Epsilon, sid_second_to_new[other.get_initial()])
+        :param other: NFA to copy states from
+        :return: Dict mapping state ids of other to the new state ids
+        """
+        offset = self._next_state
+        sid_map = {p: offset + i for i, p in enumerate(other._states)}
+        self._next_state += len(sid_map)
+
+        for p, edges in other._states.items():
+            new_edges = {} if self._sparse else {s: set() for s in self._alphabet}
+            for s, states in edges.items():
+                if states:
+                    if s not in self._alphabet:
+                        raise NFAInvalidInput("symbol {} not in the defined alphabet".format(s))
+                    new_edges[s] = {sid_map[q] for q in states}
+            sid = sid_map[p]
+            self._states[sid] = new_edges
+            self._state_names[sid] = other._state_names[p]
+
+        # The reverse index is rebuilt on demand rather than updated per edge
+        self._predecessors = None
+        self._sources = None
+        self._invalidate_caches()
+        return sid_map
+
+    @classmethod
+    def tagged_union(cls, patterns):
+        """
+        Combine several NFAs into one NFA matching anything that any of them
+        matches, keeping track of which of them matched.
 
-        # Set all final states from second NFA as finals in new NFA
-        for p in other.get_finals():
-            concat.set_as_final_state(sid_second_to_new[p])
+        All NFAs are copied in a single pass. A new start state gets an epsilon
+        transition to each of their start states, and their final states stay
+        final, tagged with the pattern id of the NFA they came from. The order
+        of the patterns is kept as well, and decides which pattern wins when
+        several match the same longest token in longest_match and tokenize.
 
-        return concat
+        Example:
+          combined_nfa = NFA.tagged_union({'int': nfa1, 'name': nfa2})
+          combined_nfa.matching_tags('123')  -> {'int'}
 
-    def __add__(self, other):
+        :param patterns: Dict of format {pattern_id: NFA, ...}, or a sequence of
+                         NFAs using their positions as pattern ids
+        :return: Combined new NFA
         """
-        Combine two NFAs to a new NFA matching anything that either input NFA matches.
+        items = list(patterns.items() if isinstance(patterns, dict) else enumerate(patterns))
+        nfas = cls._check_operands([nfa for _, nfa in items])
+        union = cls(set().union(*[nfa._alphabet for nfa in nfas]), sparse=nfas[0]._sparse)
+        union._tag_order = {pattern_id: i for i, (pattern_id, _) in enumerate(items)}
+        start = union.new_state(initial=True)
+        for pattern_id, nfa in items:
+            sid_map = union._absorb(nfa)
+            union._add_edges(start, Epsilon, (sid_map[nfa.get_initial()],))
+            for p in nfa.get_finals():
+                union._finals.add(sid_map[p])
+                union._tags.setdefault(sid_map[p], set()).add(pattern_id)
+
+        union._invalidate_caches()
+        return union
+
+    @classmethod
+    def concat_all(cls, nfas):
+        """
+        Concatenate a number of NFAs in a single pass.
+        A new NFA is returned, leaving all input NFAs unchanged.
 
         Example:
-          combined_nfa = nfa1 + nfa2
+          combined_nfa = NFA.concat_all([nfa1, nfa2, nfa3])
 
-          combined_nfa will match any input string that is a matching
-          string in either nfa1 or nfa2
+          combined_nfa will match any input string that is a matching string
+          from nfa1, followed by one from nfa2, followed by one from nfa3
 
-        :param other: Other NFA to be combined with this one
-        :return: Combined new NFA
+        :param nfas: Iterable of NFAs, in order
+        :return: Concatenated new NFA
         """
-        concat = NFA(self._alphabet)
-
-        sid_first_to_new = {}
-        sid_new_to_first = {}
-        sid_second_to_new = {}
-        sid_new_to_second = {}
+        nfas = cls._check_operands(nfas)
+        concat = cls(set().union(*[nfa._alphabet for nfa in nfas]), sparse=nfas[0]._sparse)
+
+        finals = None
+        for nfa in nfas:
+            sid_map = concat._absorb(nfa)
+            start = sid_map[nfa.get_initial()]
+            if finals is None:
+                # First NFA start state is the new start state
+                concat._initial = start
+            else:
+                # Connect all final states so far to start state of this NFA
+                for p in finals:
+                    concat._add_edges(p, Epsilon, (start,))
+            finals = [sid_map[p] for p in nfa.get_finals()]
+
+        # Final states of the last NFA are finals in new NFA, with their tags
+        for p in nfas[-1].get_finals():
+            sid = sid_map[p]
+            concat._finals.add(sid)
+            if p in nfas[-1]._tags:
+                concat._tags[sid] = set(nfas[-1]._tags[p])
+        concat._tag_order = dict(nfas[-1]._tag_order)
+
+        concat._invalidate_caches()
+        return concat
 
-        # Add all states from first NFA to new NFA
-        for p, name in self.get_states().items():
-            sid = concat.new_state(name=name)
-            sid_first_to_new[p] = sid
-            sid_new_to_first[sid] = p
+    @classmethod
+    def union_all(cls, nfas):
+        """
+        Combine a number of NFAs in a single pass to a new NFA matching anything
+        that any input NFA matches. All input NFAs are left unchanged.
 
-        # Add all states from second NFA
-        for p, name in other.get_states().items():
-            sid = concat.new_state(name=name)
-            sid_second_to_new[p] = sid
-            sid_new_to_second[sid] = p
+        Example:
+          combined_nfa = NFA.union_all([nfa1, nfa2, nfa3])
 
-        # Add all transitions from first NFA
-        for p in self.get_states():
-            for s, states in self.get_edges_from_state(p).items():
-                concat.new_edge_set(sid_first_to_new[p], s, set([sid_first_to_new[q] for q in states]))
+          combined_nfa will match any input string that is a matching
+          string in either nfa1, nfa2 or nfa3
 
-        # Add all transitions from second NFA
-        for p in other.get_states():
-            for s, states in other.get_edges_from_state(p).items():
-                concat.new_edge_set(sid_second_to_new[p], s, set([sid_second_to_new[q] for q in states]))
+        :param nfas: Iterable of NFAs
+        :return: Combined new NFA
+        """
+        nfas = cls._check_operands(nfas)
+        union = cls(set().union(*[nfa._alphabet for nfa in nfas]), sparse=nfas[0]._sparse)
+        sid_maps = [union._absorb(nfa) for nfa in nfas]
 
         # Add new start state
-        start = concat.new_state(initial=True)
+        start = union.new_state(initial=True)
 
         # Add new final state
-        final = concat.new_state(final=True)
+        final = union.new_state(final=True)
 
-        # Add epsilon transitions from new start to both old start states
-        concat.new_edge(start, Epsilon, sid_first_to_new[self.get_initial()])
-        concat.new_edge(start, Epsilon, sid_second_to_new[other.get_initial()])
+        for nfa, sid_map in zip(nfas, sid_maps):
+            # Add epsilon transition from new start to old start state
+            union._add_edges(start, Epsilon, (sid_map[nfa.get_initial()],))
 
-        # Connect all final states in first NFA to new final state
-        for p in self.get_finals():
-            concat.new_edge(sid_first_to_new[p], Epsilon, final)
+            # Connect all old final states to new final state
+            for p in nfa.get_finals():
+                union._add_edges(sid_map[p], Epsilon, (final,))
 
-        # Connect all final states in second NFA to new final state
-        for p in other.get_finals():
-            concat.new_edge(sid_second_to_new[p], Epsilon, final)
+        union._invalidate_caches()
+        return union
 
-        return concat
+    @staticmethod
+    def _check_operands(nfas):
+        nfas = list(nfas)
+        if not nfas:
+            raise NFAException("no NFAs to combine")
+        for nfa in nfas:
+            if nfa.get_initial() is None:
+                raise NFAException("NFA has no initial state")
+        return nfas
 
-    def star(self):
+    def __or__(self, other):
         """
-        Create a new NFA matching zero or more strings from input NFA
+        Concatenate two NFAs
+        A new NFA is returned with the concatenated NFAs, leaving both input NFAs unchanged
 
         Example:
-          new_nfa = nfa1.star()
+          combined_nfa = nfa1 | nfa2
 
-          new_nfa matches any matching string from nfa1 zero or more times
+          combined_nfa will match any input string that is a matching
+          string from nfa1 concatenated with a matching string from nfa2
 
-        :return: new NFA
+        To concatenate many NFAs, NFA.concat_all is faster than chaining |
+
+        :param other: Other NFA to be concatenated after this one
+        :return: Concatenated new NFA
         """
-        new_nfa = NFA(self._alphabet)
+        return self.concat_all([self, other])
 
-        sid_this_to_new = {}
+    def __add__(self, other):
+        """
+        Combine two NFAs to a new NFA matching anything that either input NFA matches.
 
-        # Add all states from this NFA to new NFA
-        for p, name in self.get_states().items():
-            sid = new_nfa.new_state(name=name)
-            sid_this_to_new[p] = sid
+        Example:
+          combined_nfa = nfa1 + nfa2
+
+          combined_nfa will match any input string that is a matching
+          string in either nfa1 or nfa2
+
+        To combine many NFAs, NFA.union_all is faster than chaining +
+
+        :param other: Other NFA to be combined with this one
+        :return: Combined new NFA
+        """
+        return self.union_all([self, other])
+
+    def __and__(self, other):
+        """
+        Create a new NFA matching anything that both input NFAs match,
+        leaving both input NFAs unchanged.
+
+        Example:
+          combined_nfa = nfa1 & nfa2
+
+          combined_nfa will match any input string that is a matching
+          string in both nfa1 and nfa2
+
+        :param other: Other NFA to be intersected with this one
+        :return: New NFA without epsilon transitions
+        """
+        return self._product(other, difference=False)
+
+    def __sub__(self, other):
+        """
+        Create a new NFA matching anything that this NFA matches but the
+        other does not, leaving both input NFAs unchanged.
+
+        Example:
+          combined_nfa = nfa1 - nfa2
+
+          combined_nfa will match any input string that is a matching
+          string in nfa1 but not in nfa2
+
+        :param other: NFA whose matching strings are removed from this one
+        :return: New NFA without epsilon transitions
+        """
+        return self._product(other, difference=True)
+
+    def _product(self, other, difference):
+        """
+        Product construction for intersection and difference, exploring
+        only the pair states that are reachable from the initial pair.
+
+        A pair is (mask of this NFA, mask of other), both epsilon closed
+        bitmasks from the matching tables. The left mask is split into
+        single states as in the NFA itself. For an intersection the right
+        mask is split the same way, while for a difference other is
+        determinized on the fly, since a pair must know that no state of
+        other accepts. States of this NFA that cannot reach a final state
+        are never entered, nor are those of other for an intersection.
+        Symbols that neither NFA tells apart share one move.
+        Tags of final states of this NFA are kept.
+
+        :param other: Right hand NFA
+        :param difference: True for self - other, False for self & other
+        :return: New NFA without epsilon transitions
+        """
+        self._check_operands([self, other])
+        a = self._bitsets()
+        b = other._bitsets()
+        live_a = a.to_mask(self.coreachable_states())
+        live_b = -1 if difference else b.to_mask(other.coreachable_states())
+
+        product = type(self)(self._alphabet | other._alphabet, sparse=self._sparse)
+        product._tag_order = dict(self._tag_order)
+        groups = {}
+        for sym in _sorted_symbols(self._alphabet - {Epsilon}):
+            groups.setdefault((a.class_of[sym], b.class_of.get(sym)), []).append(sym)
+        rows = [(members, a.class_rows[ca], None if cb is None else b.class_rows[cb])
+                for (ca, cb), members in groups.items()]
+
+        step = self._step_row
+
+        def split(mask):
+            while mask:
+                low = mask & -mask
+                yield low
+                mask ^= low
+
+        def new_pair(pair):
+            left, right = pair
+            sid = product.new_state(name="{{{}}},{{{}}}".format(
+                ",".join([str(p) for p in sorted(a.to_set(left))]),
+                ",".join([str(p) for p in sorted(b.to_set(right))])))
+            if left & a.finals and bool(right & b.finals) != difference:
+                product._finals.add(sid)
+                tags = a.tags_of(left)
+                if tags != _UNTAGGED:
+                    product._tags[sid] = tags
+            return sid
+
+        pair = (a.initial & live_a, b.initial & live_b)
+        product._initial = new_pair(pair)
+        pairs = {pair: product._initial}  # {(bitmask, bitmask):state}
+        unmarked = deque([pair])
+
+        while unmarked:
+            pair = unmarked.popleft()
+            sid = pairs[pair]
+            left, right = pair
+            for members, row_a, row_b in rows:
+                next_left = step(row_a, left) & live_a
+                next_right = step(row_b, right) & live_b
+                if not next_left or not (difference or next_right):
+                    continue
+                if difference:
+                    next_pairs = [(p, next_right) for p in split(next_left)]
+                else:
+                    next_pairs = [(p, q) for p in split(next_left) for q in split(next_right)]
+
+                targets = set()
+                for next_pair in next_pairs:
+                    target = pairs.get(next_pair)
+                    if target is None:
+                        target = pairs[next_pair] = new_pair(next_pair)
+                        unmarked.append(next_pair)
+                    targets.add(target)
+                for sym in members:
+                    product._add_edges(sid, sym, targets)
+
+        product._invalidate_caches()
+        return product
+
+    def star(self):
+        """
+        Create a new NFA matching zero or more strings from input NFA
+
+        Example:
+          new_nfa = nfa1.star()
+
+          new_nfa matches any matching string from nfa1 zero or more times
 
-        # Add all transitions from this NFA
-        for p in self.get_states():
-            for s, states in self.get_edges_from_state(p).items():
-                new_nfa.new_edge_set(sid_this_to_new[p], s, set([sid_this_to_new[q] for q in states]))
+        :return: new NFA
+        """
+        new_nfa = type(self)(self._alphabet, sparse=self._sparse)
+        sid_map = new_nfa._absorb(self)
+        new_nfa._initial = None if self._initial is None else sid_map[self._initial]
+        new_nfa._finals = {sid_map[p] for p in self._finals}
+        return new_nfa.star_inplace()
+
+    def star_inplace(self):
+        """
+        Make this NFA match zero or more strings that it matched before,
+        without copying it like star() does.
+
+        :return: This NFA
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
+
+        old_initial = self._initial
+        old_finals = list(self._finals)
+        self._finals.clear()
+        self._tags.clear()
 
         # Add new start state
-        start = new_nfa.new_state(initial=True)
+        start = self.new_state(initial=True)
 
         # Add new final state
-        final = new_nfa.new_state(final=True)
+        final = self.new_state(final=True)
 
         # Add epsilon transitions from new start to old start state
-        new_nfa.new_edge(start, Epsilon, sid_this_to_new[self.get_initial()])
+        self._add_edges(start, Epsilon, (old_initial,))
 
         # Add epsilon transition from new start state to new final state
-        new_nfa.new_edge(start, Epsilon, final)
+        self._add_edges(start, Epsilon, (final,))
 
         # Add epsilon transition from all old final states to old start state and to new final state
-        for p in self.get_finals():
-            s = sid_this_to_new[p]
-            new_nfa.new_edge(s, Epsilon, sid_this_to_new[self.get_initial()])
-            new_nfa.new_edge(s, Epsilon, final)
+        for p in old_finals:
+            self._add_edges(p, Epsilon, (old_initial, final))
 
-        return new_nfa
+        self._invalidate_caches()
+        return self
 
     def closure(self, p):
         """
@@ -455,55 +1817,860 @@ class NFA(object):
         :param p: State id to get closure of
         :return: Set of states that is the closure of p
         """
-        if not isinstance(p, set):
-            closure_states = {p}
-        else:
-            closure_states = p
-        processed = set()
-        while closure_states ^ processed:
-            for p in list(closure_states ^ processed):
-                closure_states |= self.get_edges_from_state(p)[Epsilon]
-                processed.add(p)
+        if self._stats is not None:
+            return self._closure_profiled(p)
+
+        if self.is_epsilon_free():
+            return set(p) if isinstance(p, (set, frozenset)) else {p}
+
+        closures = self._epsilon_closures()
+        if not isinstance(p, (set, frozenset)):
+            return set(closures[p])
+
+        closure_states = set()
+        for q in p:
+            closure_states |= closures[q]
 
         return closure_states
 
-    def subset_construct_dfa(self):
+    def _closure_profiled(self, p):
+        """
+        closure, recording counters and timers in the stats object
+        """
+        stats = self._stats
+        closures = self._profiled_table('_closure_table', self._epsilon_closures)
+        start = perf_counter()
+        if isinstance(p, (set, frozenset)):
+            closure_states = set()
+            for q in p:
+                closure_states |= closures[q]
+        else:
+            closure_states = set(closures[p])
+        stats.count('closures')
+        stats.add_time('closure', perf_counter() - start)
+        return closure_states
+
+    def subset_construct_dfa(self, trim=False):
         """
         Convert an NFA to the equivalent DFA by subset construction.
         It is still an instance of class NFA, but it has only deterministic properties.
         I.e, at most one edge on each symbol from any state, and no epsilon transitions.
 
+        Subsets of NFA states are kept as bitmasks from the matching tables,
+        so each subset is hashed and compared as a single int. Moves are
+        computed once per symbol class rather than once per symbol.
+
+        :param trim: If True, run the construction on a trimmed copy of this NFA,
+                     so dead states never end up in a subset. DFA state names then
+                     refer to the renumbered states of the copy.
         :return: new equivalent DFA instance
         """
-        def subset_str(subs):
-            return "{{{}}}".format(",".join([str(i) for i in subs]))
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
 
-        dfa = NFA(self._alphabet - {Epsilon})
-        subsets = {}
-        unmarked = []
-        subset = self.closure(self._initial)
-        sid = dfa.new_state(initial=True, name=','.join([str(sid) for sid in subset]))
-        subsets[subset_str(subset)] = sid
-        unmarked.append(subset)
+        if trim:
+            nfa = type(self)(self._alphabet, sparse=self._sparse)
+            sid_map = nfa._absorb(self)
+            nfa._initial = sid_map[self._initial]
+            nfa._finals = {sid_map[p] for p in self._finals}
+            nfa._tags = {sid_map[p]: set(tags) for p, tags in self._tags.items()}
+            nfa._tag_order = self._tag_order
+            nfa.trim()
+            nfa._stats = self._stats
+            return nfa.subset_construct_dfa()
+
+        stats = self._stats
+        if stats is not None:
+            tables = self._profiled_table('_bitset_tables', self._bitsets)
+            start = perf_counter()
+        else:
+            tables = self._bitsets()
+
+        def subset_str(mask):
+            return "{{{}}}".format(",".join([str(p) for p in sorted(tables.to_set(mask))]))
+
+        dfa = NFA(self._alphabet - {Epsilon}, sparse=self._sparse)
+        dfa._tag_order = dict(self._tag_order)
+        _, classes = self._classes()
+        rows = list(zip(classes, tables.class_rows))
+
+        def set_final(sid, mask):
+            # A DFA state is tagged with the tags of all NFA finals in its subset
+            tags = tables.tags_of(mask)
+            if tags:
+                dfa.set_as_final_state(sid)
+                if tags != _UNTAGGED:
+                    dfa._tags[sid] = tags
+
+        subset = tables.initial
+        sid = dfa.new_state(initial=True, name=','.join([str(p) for p in sorted(tables.to_set(subset))]))
+        set_final(sid, subset)
+        subsets = {subset: sid}  # {bitmask:state}
+        unmarked = deque([subset])
 
         while unmarked:
-            for t in list(unmarked):
-                t_sid = subsets[subset_str(t)]
-                unmarked.remove(t)
-                for sym in self._alphabet - {Epsilon}:
-                    subset = self.closure(self.move(t, sym))
-                    if subset_str(subset) not in subsets:
-                        sid = dfa.new_state(name=subset_str(subset))
-                        if subset & self._finals:
-                            dfa.set_as_final_state(sid)
-                        subsets[subset_str(subset)] = sid
-                        unmarked.append(subset)
-                        dfa.new_edge(t_sid, sym, sid)
-                    else:
-                        dfa.new_edge(t_sid, sym, subsets[subset_str(subset)])
+            t = unmarked.popleft()
+            t_sid = subsets[t]
+            for members, row in rows:
+                subset = 0
+                mask = t
+                while mask:
+                    low = mask & -mask
+                    subset |= row[low.bit_length() - 1]
+                    mask ^= low
+
+                sid = subsets.get(subset)
+                if sid is None:
+                    sid = dfa.new_state(name=subset_str(subset))
+                    set_final(sid, subset)
+                    subsets[subset] = sid
+                    unmarked.append(subset)
+                for sym in members:
+                    dfa.new_edge(t_sid, sym, sid)
+
+        if stats is not None:
+            stats.count('dfa_states', len(subsets))
+            stats.count('subset_moves', len(subsets) * len(rows))
+            stats.add_time('subset_construction', perf_counter() - start)
+        return dfa
+
+    def reachable_states(self):
+        """
+        Get the states that can be reached from the initial state
+
+        :return: Set of state ids
+        """
+        if self._initial is None:
+            return set()
+
+        reached = {self._initial}
+        stack = [self._initial]
+        while stack:
+            for states in self._states[stack.pop()].values():
+                for q in states:
+                    if q not in reached:
+                        reached.add(q)
+                        stack.append(q)
 
+        return reached
+
+    def coreachable_states(self):
+        """
+        Get the states from which a final state can be reached
+
+        :return: Set of state ids
+        """
+        predecessors = self._reverse_index()[0]
+
+        live = set(self._finals)
+        stack = list(live)
+        while stack:
+            for p in predecessors.get(stack.pop(), ()):
+                if p not in live:
+                    live.add(p)
+                    stack.append(p)
+
+        return live
+
+    def trim(self):
+        """
+        Remove all states that are unreachable from the initial state or
+        from which no final state can be reached, then renumber the
+        remaining states densely from 0, keeping their order and names.
+        The initial state is always kept, so an NFA that accepts nothing
+        is trimmed down to just its initial state.
+
+        Example:
+          nfa = (nfa1 | nfa2).star()
+          removed = nfa.trim()
+
+        :return: Number of states removed
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
+
+        useful = self.reachable_states() & self.coreachable_states()
+        useful.add(self._initial)
+        removed = len(self._states) - len(useful)
+        if not removed and self._next_state == len(self._states):
+            return 0
+
+        sid_map = {p: i for i, p in enumerate(sorted(useful))}
+        states = {}
+        state_names = {}
+        for p, sid in sid_map.items():
+            edges = {} if self._sparse else {s: set() for s in self._alphabet}
+            for s, targets in self._states[p].items():
+                kept = {sid_map[q] for q in targets if q in sid_map}
+                if kept:
+                    edges[s] = kept
+            states[sid] = edges
+            state_names[sid] = self._state_names[p]
+
+        self._states = states
+        self._state_names = state_names
+        self._initial = sid_map[self._initial]
+        self._finals = {sid_map[p] for p in self._finals if p in sid_map}
+        self._tags = {sid_map[p]: tags for p, tags in self._tags.items() if p in sid_map}
+        self._next_state = len(states)
+        self._predecessors = None
+        self._sources = None
+        self._invalidate_caches()
+        return removed
+
+    def _search_step(self, threads, sym, closures, live):
+        """
+        Advance search threads over one symbol. Symbols outside the
+        alphabet end all threads.
+
+        :param threads: Dict mapping epsilon closed states to the leftmost start of a run reaching them
+        :return: Dict of the same format after consuming sym
+        """
+        next_threads = {}
+        for p, start in threads.items():
+            for q in self._states[p].get(sym, ()):
+                for r in closures[q]:
+                    if r in live and start < next_threads.get(r, start + 1):
+                        next_threads[r] = start
+        return next_threads
+
+    def finditer(self, text, mode='leftmost-longest'):
+        """
+        Find matches of this NFA inside a longer text.
+
+        The text is scanned left to right while a new run of the NFA is
+        started at every position, and for each state only the run that
+        started leftmost is kept. Symbols outside the alphabet never take
+        part in a match.
+
+        Modes:
+          'leftmost-longest': Non-overlapping matches, each starting as far
+                              left as possible and then being as long as possible.
+                              Scanning resumes at the end of each match, as in re.finditer.
+          'all':              For every position where a match ends, the leftmost
+                              starting match ending there. Overlapping matches are
+                              reported, and the text is read exactly once.
+
+        Time is linear in the length of the text in both modes. In
+        'leftmost-longest' mode a match is only known to be longest once
+        all runs that could extend it have died, so the text past its end
+        is read ahead. The states seen there that led to no match are
+        remembered per position and dropped when scanning resumes, so each
+        position is read at most once per state instead of once per match,
+        e.g. for 'a|a*b' on a long run of a's.
+
+        Example:
+           nfa.build_from_string('ab')
+           list(nfa.finditer('xabyab'))  -> [(1, 3), (4, 6)]
+
+        :param text: Sequence of input symbols
+        :param mode: 'leftmost-longest' or 'all'
+        :return: Generator of (start, end) spans, with text[start:end] matching
+        """
+        if mode not in ('leftmost-longest', 'all'):
+            raise NFAException("unknown search mode {}".format(mode))
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
+
+        if not hasattr(text, '__getitem__'):
+            text = list(text)
+        return self._finditer(text, mode == 'all')
+
+    def _finditer(self, text, overlapped):
+        closures = self._epsilon_closures()
+        live = self.coreachable_states()
+        finals = self._finals
+        initial = [p for p in closures[self._initial] if p in live]
+        end = len(text)
+
+        failed = {}  # {position:set(states)} from which no match ends
+        pos = 0
+        while pos <= end:
+            threads = {}
+            match = None
+            visited = []  # (position, states) read since the last accepting position
+            i = pos
+            while True:
+                if match is None or overlapped:
+                    for p in initial:
+                        if p not in threads:
+                            threads[p] = i
+                if i in failed:
+                    dead = failed[i]
+                    threads = {p: s for p, s in threads.items() if p not in dead}
+
+                accepted = [start for p, start in threads.items() if p in finals]
+                if accepted:
+                    start = min(accepted)
+                    visited = []
+                    if overlapped:
+                        yield (start, i)
+                    elif match is None or start <= match[0]:
+                        match = (start, i)
+                        threads = {p: s for p, s in threads.items() if s <= start}
+                elif threads and not overlapped:
+                    visited.append((i, list(threads)))
+
+                if i == end or not threads and (match is not None or not initial):
+                    break
+                threads = self._search_step(threads, text[i], closures, live) if threads else {}
+                i += 1
+
+            if overlapped or match is None:
+                return
+            yield match
+            for position, states in visited:
+                failed.setdefault(position, set()).update(states)
+            next_pos = match[1] if match[1] > match[0] else match[1] + 1
+            for position in range(pos, next_pos):
+                failed.pop(position, None)
+            pos = next_pos
+
+    def search(self, text):
+        """
+        Find the leftmost-longest match of this NFA inside a longer text.
+
+        :param text: Sequence of input symbols
+        :return: (start, end) span of the match, or None if there is no match
+        """
+        return next(self.finditer(text), None)
+
+    def _live_mask(self):
+        """
+        Get the matching tables together with the bitmask of their states
+        that can reach a final state, computing the mask first if needed.
+
+        :return: Tuple (_BitsetTables, bitmask)
+        """
+        tables = self._bitsets()
+        if tables.live is None:
+            tables.live = tables.to_mask(self.coreachable_states())
+        return tables, tables.live
+
+    def longest_match(self, seq, start=0):
+        """
+        Find the longest prefix of seq[start:] that this NFA matches.
+
+        The active state set is advanced once per symbol and the last
+        position where it held a final state is remembered, so the cost
+        is linear in how far the match could possibly extend. Scanning
+        stops as soon as no state that can still reach a final state is
+        active, or at a symbol outside the alphabet.
+
+        If several tagged final states accept the longest match, the tag of
+        the pattern given first to tagged_union wins, so keywords listed before
+        a general identifier pattern match as keywords. Tags without a recorded
+        pattern order are ranked by sorting them.
+
+        Example:
+          lexer = NFA.tagged_union([compile_regex('if', alphabet), compile_regex('[a-z]+', alphabet)])
+          lexer.longest_match('if x', 0)  -> (2, 0)
+          lexer.longest_match('ifs', 0)   -> (3, 1)
+
+        :param seq: Sequence of input symbols
+        :param start: Position in seq to match from
+        :return: Tuple (end, tag) with seq[start:end] matching, or None if no prefix matches
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
+
+        tables, live = self._live_mask()
+        return self._longest_match(tables, live, seq, start)
+
+    @staticmethod
+    def _longest_match(tables, live, seq, start, failed=None):
+        """
+        :param failed: Optional dict of format {position: set(bitmasks)} of state sets known
+                       to reach no final state from that position on. Scanning stops at
+                       any of them, and the state sets read past the match are added.
+        """
+        delta = tables.delta
+        finals = tables.finals
+        current = tables.initial & live
+        last_end, last_mask = (start, current) if current & finals else (None, 0)
+        visited = []  # (position, bitmask) read since the last accepting position
+
+        i = start
+        end = len(seq)
+        while current and i < end:
+            if failed is not None and current in failed.get(i, ()):
+                break
+            row = delta.get(seq[i])
+            if row is None:
+                break
+            mask = current
+            current = 0
+            while mask:
+                low = mask & -mask
+                current |= row[low.bit_length() - 1]
+                mask ^= low
+            current &= live
+            i += 1
+            if current & finals:
+                last_end, last_mask = i, current
+                visited = []
+            elif current and failed is not None:
+                visited.append((i, current))
+
+        if failed is not None:
+            for position, mask in visited:
+                failed.setdefault(position, set()).add(mask)
+        if last_end is None:
+            return None
+        return last_end, _first_tag(tables.tags_of(last_mask), tables.tag_order)
+
+    def tokenize(self, seq):
+        """
+        Split seq into tokens by repeatedly taking the longest match from
+        where the previous token ended, like a lexer. Each token is tagged
+        as in longest_match, so a tagged_union of the token patterns tells
+        which pattern every token matched, and a token that several patterns
+        match goes to the one listed first.
+
+        Example:
+          lexer = NFA.tagged_union({'num': compile_regex('[0-9]+', alphabet),
+                                    'space': compile_regex(' +', alphabet)})
+          list(lexer.tokenize('12 3'))  -> [('num', 0, 2), ('space', 2, 3), ('num', 3, 4)]
+
+        Finding the end of a token may read ahead past it while a longer
+        token is still possible. The state sets seen there that led to no
+        token are remembered per position, so later tokens stop as soon as
+        they reach one of them. Each position is then read at most once per
+        distinct state set, which keeps the whole pass linear in the length
+        of seq for a given lexer, instead of quadratic as for repeated
+        longest_match calls on e.g. tokens 'a' and 'a*b' over a run of a's.
+
+        Throws NFAException at a position where no non-empty token matches.
+
+        :param seq: Sequence of input symbols
+        :return: Generator of (tag, start, end) per token, with seq[start:end] being the token
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
+
+        if not hasattr(seq, '__getitem__'):
+            seq = list(seq)
+        return self._tokenize(seq)
+
+    def _tokenize(self, seq):
+        tables, live = self._live_mask()
+        failed = {}  # {position:set(bitmasks)} known not to lead to a token
+        pos = 0
+        end = len(seq)
+        while pos < end:
+            match = self._longest_match(tables, live, seq, pos, failed)
+            if match is None or match[0] == pos:
+                raise NFAException("no token matches at position {}".format(pos))
+            yield match[1], pos, match[0]
+            for position in range(pos, match[0]):
+                failed.pop(position, None)
+            pos = match[0]
+
+    def matcher(self):
+        """
+        Create a Matcher that consumes input chunk by chunk.
+
+        :return: new Matcher instance
+        """
+        return Matcher(self)
+
+    def is_epsilon_free(self):
+        """
+        Check if this NFA has no epsilon transitions. The result is cached
+        until the NFA is modified, and move, closure and the matching tables
+        skip all closure work for epsilon free NFAs.
+        """
+        if self._epsilon_free is None:
+            self._epsilon_free = not any(edges.get(Epsilon) for edges in self._states.values())
+        return self._epsilon_free
+
+    def remove_epsilons(self):
+        """
+        Create an equivalent NFA without epsilon transitions.
+
+        The new NFA has the same states. Each state gets the edges of all
+        states in its epsilon closure, and is final if its closure holds a
+        final state, with the tags of all finals in the closure.
+
+        :return: new epsilon free NFA
+        """
+        closures = self._epsilon_closures()
+        nfa = type(self)(self._alphabet, sparse=self._sparse)
+        for p, closure_states in closures.items():
+            edges = {} if self._sparse else {s: set() for s in self._alphabet}
+            for q in closure_states:
+                for sym, targets in self._states[q].items():
+                    if targets and sym is not Epsilon:
+                        edges.setdefault(sym, set()).update(targets)
+            nfa._states[p] = edges
+            nfa._state_names[p] = self._state_names[p]
+
+            finals = closure_states & self._finals
+            if finals:
+                nfa._finals.add(p)
+                tags = set()
+                for q in finals:
+                    tags |= self._tags.get(q, _UNTAGGED)
+                if tags != _UNTAGGED:
+                    nfa._tags[p] = tags
+
+        nfa._tag_order = dict(self._tag_order)
+        nfa._initial = self._initial
+        nfa._next_state = self._next_state
+        return nfa
+
+    def is_deterministic(self):
+        """
+        Check if this NFA has deterministic properties, i.e. no epsilon
+        transitions and at most one edge on each symbol from any state.
+        """
+        for edges in self._states.values():
+            for s, states in edges.items():
+                if states and (s is Epsilon or len(states) > 1):
+                    return False
+        return True
+
+    def complement(self):
+        """
+        Create a new DFA matching exactly the strings over the alphabet that
+        this DFA does not match. Missing transitions are first completed with
+        edges to a new dead state, which then becomes final. Tags are not kept.
+
+        Example:
+          dfa = nfa.subset_construct_dfa().complement()
+
+        :return: New complete DFA
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
+        if not self.is_deterministic():
+            raise NFAException("NFA is not deterministic")
+
+        dfa = type(self)(self._alphabet, sparse=self._sparse)
+        sid_map = dfa._absorb(self)
+        dfa._initial = sid_map[self._initial]
+        dfa._finals = {sid for p, sid in sid_map.items() if p not in self._finals}
+
+        symbols = _sorted_symbols(self._alphabet - {Epsilon})
+        dead = None
+        for sid in sid_map.values():
+            for sym in symbols:
+                if not dfa._states[sid].get(sym):
+                    if dead is None:
+                        dead = dfa.new_state(final=True)
+                    dfa._add_edges(sid, sym, (dead,))
+        if dead is not None:
+            for sym in symbols:
+                dfa._add_edges(dead, sym, (dead,))
+
+        dfa._invalidate_caches()
         return dfa
 
+    def _class_moves(self, other):
+        """
+        Group the symbols of both NFAs by the pair of symbol classes they
+        fall in, so that symbols neither NFA tells apart are moved on once.
+
+        :return: List of (symbol, row of this NFA or None, row of other or None) per group
+        """
+        a = self._bitsets()
+        b = other._bitsets()
+        groups = {}
+        for sym in _sorted_symbols((self._alphabet | other._alphabet) - {Epsilon}):
+            key = (a.class_of.get(sym), b.class_of.get(sym))
+            if key not in groups:
+                groups[key] = sym
+        return [(sym, None if ca is None else a.class_rows[ca], None if cb is None else b.class_rows[cb])
+                for (ca, cb), sym in groups.items()]
+
+    @staticmethod
+    def _step_row(row, mask):
+        """
+        :return: Epsilon closed bitmask reached from mask over a transition row, 0 if row is None
+        """
+        next_mask = 0
+        if row is not None:
+            while mask:
+                low = mask & -mask
+                next_mask |= row[low.bit_length() - 1]
+                mask ^= low
+        return next_mask
+
+    def is_empty(self):
+        """
+        Check if this NFA matches no input at all, by a breadth first search
+        for a final state over the states themselves, without determinizing.
+
+        Example:
+          result = (nfa1 & nfa2).is_empty()
+          if not result:
+              print(result.counterexample)  -> a shortest input matched by both
+
+        :return: CheckResult, with a shortest matching input as counterexample if not empty
+        """
+        self._check_operands([self])
+        tables = self._bitsets()
+        rows = [(members[0], row) for members, row in zip(self._classes()[1], tables.class_rows)]
+
+        parents = {}  # {bit:(parent bit, symbol)}
+        queue = deque()
+        for bit in range(tables.initial.bit_length()):
+            if tables.initial >> bit & 1:
+                parents[bit] = None
+                queue.append(bit)
+
+        while queue:
+            bit = queue.popleft()
+            if tables.finals >> bit & 1:
+                return CheckResult(False, _trace(parents, bit))
+            for sym, row in rows:
+                mask = row[bit]
+                while mask:
+                    low = mask & -mask
+                    q = low.bit_length() - 1
+                    if q not in parents:
+                        parents[q] = (bit, sym)
+                        queue.append(q)
+                    mask ^= low
+
+        return CheckResult(True)
+
+    def is_equivalent(self, other):
+        """
+        Check if this NFA and other match exactly the same inputs.
+
+        Uses the Hopcroft-Karp algorithm: both NFAs are determinized on the
+        fly, one subset at a time, and pairs of subsets are merged with
+        union-find so that each subset is only explored until it is known
+        to be equivalent to one already seen.
+
+        Example:
+          result = old_patterns.is_equivalent(new_patterns)
+          if not result:
+              print(result.counterexample)  -> input matched by only one of them
+
+        :param other: NFA to compare with
+        :return: CheckResult, with an input matched by only one of the NFAs as counterexample if not equivalent
+        """
+        self._check_operands([self, other])
+        a = self._bitsets()
+        b = other._bitsets()
+        moves = self._class_moves(other)
+        step = self._step_row
+
+        leader = {}  # union-find over (0, subset of self) and (1, subset of other)
+
+        def find(x):
+            root = x
+            while leader.get(root, root) != root:
+                root = leader[root]
+            while x != root:
+                leader[x], x = root, leader[x]
+            return root
+
+        pair = (a.initial, b.initial)
+        leader[(1, pair[1])] = (0, pair[0])
+        parents = {pair: None}  # {(bitmask, bitmask):(parent pair, symbol)}
+        queue = deque([pair])
+        while queue:
+            pair = queue.popleft()
+            left, right = pair
+            if bool(left & a.finals) != bool(right & b.finals):
+                return CheckResult(False, _trace(parents, pair))
+            for sym, row_a, row_b in moves:
+                next_pair = (step(row_a, left), step(row_b, right))
+                x = find((0, next_pair[0]))
+                y = find((1, next_pair[1]))
+                if x != y:
+                    leader[y] = x
+                    parents[next_pair] = (pair, sym)
+                    queue.append(next_pair)
+
+        return CheckResult(True)
+
+    def is_subset_of(self, other):
+        """
+        Check if every input this NFA matches is matched by other as well.
+
+        Uses the antichain algorithm: pairs of a state of this NFA and a
+        subset of states of other are explored breadth first, and a pair is
+        skipped when a pair with the same state and a subset of its subset
+        has been seen, since any input that fails for the skipped pair fails
+        for that one as well.
+
+        Example:
+          result = new_patterns.is_subset_of(old_patterns)
+          if not result:
+              print(result.counterexample)  -> input matched by new_patterns only
+
+        :param other: NFA that should match everything this one matches
+        :return: CheckResult, with an input matched by this NFA but not by other as counterexample if not a subset
+        """
+        self._check_operands([self, other])
+        a = self._bitsets()
+        b = other._bitsets()
+        live = a.to_mask(self.coreachable_states())
+        moves = self._class_moves(other)
+        step = self._step_row
+
+        antichain = {}  # {bit:[minimal subsets of other seen with this state]}
+        parents = {}  # {(bit, bitmask):(parent pair, symbol)}
+        queue = deque()
+
+        def visit(pair, link):
+            bit, subset = pair
+            seen = antichain.setdefault(bit, [])
+            for s in seen:
+                if s & ~subset == 0:
+                    return
+            seen[:] = [s for s in seen if subset & ~s != 0]
+            seen.append(subset)
+            parents[pair] = link
+            queue.append(pair)
+
+        mask = a.initial & live
+        while mask:
+            low = mask & -mask
+            visit((low.bit_length() - 1, b.initial), None)
+            mask ^= low
+
+        while queue:
+            pair = queue.popleft()
+            bit, subset = pair
+            if a.finals >> bit & 1 and not subset & b.finals:
+                return CheckResult(False, _trace(parents, pair))
+            for sym, row_a, row_b in moves:
+                if row_a is None:
+                    continue
+                mask = row_a[bit] & live
+                if not mask:
+                    continue
+                next_subset = step(row_b, subset)
+                while mask:
+                    low = mask & -mask
+                    visit((low.bit_length() - 1, next_subset), (pair, sym))
+                    mask ^= low
+
+        return CheckResult(True)
+
+    def minimize(self):
+        """
+        Minimize a DFA by Hopcroft's partition refinement algorithm.
+
+        Only states reachable from the initial state are kept, and states
+        that accept the same language are merged. A missing transition is
+        treated as an edge to an implicit dead state, which is not part of
+        the result, so a partial DFA stays partial and a complete one stays
+        complete.
+
+        Example:
+           dfa, state_map = nfa.subset_construct_dfa().minimize()
+
+        :return: Tuple (minimal DFA, dict mapping reachable state ids of this DFA to new state ids)
+        """
+        if self._initial is None:
+            raise NFAException("NFA has no initial state")
+        if not self.is_deterministic():
+            raise NFAException("NFA is not deterministic")
+
+        # Refining on one symbol per symbol class is enough
+        symbols = [members[0] for members in self._classes()[1]]
+        dead = None
+
+        # Reachable states and inverse transitions, with dead as sink
+        reachable = [self._initial]
+        seen = {self._initial}
+        inverse = {sym: {} for sym in symbols}  # {symbol:{state:[states]}}
+        for p in reachable:
+            edges = self._states[p]
+            for sym in symbols:
+                targets = edges.get(sym)
+                q = next(iter(targets)) if targets else dead
+                inverse[sym].setdefault(q, []).append(p)
+                if q is not dead and q not in seen:
+                    seen.add(q)
+                    reachable.append(q)
+        for sym in symbols:
+            inverse[sym].setdefault(dead, []).append(dead)
+
+        # Initial partition by acceptance and tags, all blocks but the largest are splitters
+        blocks = []
+        block_of = {}
+        groups = {}
+        for p in reachable + [dead]:
+            groups.setdefault((p in self._finals, frozenset(self._tags.get(p, ()))), []).append(p)
+        for members in groups.values():
+            for p in members:
+                block_of[p] = len(blocks)
+            blocks.append(set(members))
+
+        largest = max(range(len(blocks)), key=lambda b: len(blocks[b]))
+        pending = [(b, sym) for b in range(len(blocks)) if b != largest for sym in symbols]
+        while pending:
+            splitter, sym = pending.pop()
+            inv = inverse[sym]
+            touched = {}
+            for q in blocks[splitter]:
+                for p in inv.get(q, ()):
+                    touched.setdefault(block_of[p], set()).add(p)
+
+            for b, inside in touched.items():
+                block = blocks[b]
+                if len(inside) == len(block):
+                    continue
+                # Move the smaller part to a new block, which is then always
+                # a valid splitter whether or not block b is pending. Either
+                # way the work is O(len(inside)), which the scan above paid for.
+                if len(inside) <= len(block) - len(inside):
+                    block -= inside
+                    new_block = inside
+                else:
+                    new_block = block - inside
+                    blocks[b] = inside
+                new_b = len(blocks)
+                blocks.append(new_block)
+                for p in new_block:
+                    block_of[p] = new_b
+                for c in symbols:
+                    pending.append((new_b, c))
+
+        # Build minimal DFA, one state per block of real states
+        kept = [b for b, block in enumerate(blocks) if block - {dead}]
+        kept.sort(key=lambda b: (b != block_of[self._initial], min(blocks[b] - {dead})))
+        mdfa = NFA(self._alphabet - {Epsilon}, sparse=self._sparse)
+        new_sid = {}
+        for b in kept:
+            members = sorted(blocks[b] - {dead})
+            name = self._state_names[members[0]] if len(members) == 1 else \
+                "{{{}}}".format(",".join([str(p) for p in members]))
+            new_sid[b] = mdfa.new_state(initial=(b == block_of[self._initial]),
+                                        final=(members[0] in self._finals), name=name)
+            if members[0] in self._tags:
+                mdfa._tags[new_sid[b]] = set(self._tags[members[0]])
+        mdfa._tag_order = dict(self._tag_order)
+
+        for b in kept:
+            p = min(blocks[b] - {dead})
+            for sym, targets in self._states[p].items():
+                for q in targets:
+                    mdfa.new_edge(new_sid[b], sym, new_sid[block_of[q]])
+
+        state_map = {p: new_sid[block_of[p]] for p in reachable}
+        return mdfa, state_map
+
+    def compile_dfa(self, minimize=False):
+        """
+        Convert this NFA to a DFA by subset construction and compile it
+        into a CompiledDFA matcher.
+
+        :param minimize: If True, minimize the DFA before compiling it
+        :return: new CompiledDFA instance
+        """
+        dfa = self.subset_construct_dfa()
+        if minimize:
+            dfa, _ = dfa.minimize()
+        return CompiledDFA(dfa)
+
     def build_from_string(self, string):
         """Add transitions to this NFA that matches a simple string
         of symbols.
@@ -524,3 +2691,570 @@ class NFA(object):
             current = new
         final = self.new_state(final=True)
         self.new_edge(current, Epsilon, final)
+
+    def build_from_regex(self, pattern):
+        """Add states and transitions to this NFA that match a regular
+        expression, using Thompson's construction.
+
+        Supported syntax:
+           ab        concatenation
+           a|b       alternation
+           (ab)      grouping
+           a* a+ a?  zero or more, one or more, zero or one
+           a{2} a{2,} a{2,5}
+                     bounded repetition
+           .         any symbol in the alphabet
+           [abc] [a-z] [^0-9]
+                     character classes, ranges only include alphabet symbols
+           \\*        escaped metacharacter
+
+        Example:
+           nfa = NFA(alphabet)
+           nfa.build_from_regex('(ab|c)*d')
+
+           make nfa accept the strings "d", "abd", "cd", "ababcd", ...
+
+        :param pattern: Regular expression over single character symbols
+        """
+        self._build_from_regex_tree(_RegexParser(pattern, self._alphabet - {Epsilon}).parse())
+
+    def _build_from_regex_tree(self, tree):
+        """
+        Add the states of a parsed regular expression, with its start state
+        as initial state and its end state as final state
+        """
+        start, end = self._emit_regex(tree)
+        self.set_initial_state(start)
+        self.set_as_final_state(end)
+
+    def _emit_regex(self, node):
+        """
+        Add the states of one node of a parsed regular expression
+
+        :return: Tuple (start state, end state) of the added fragment
+        """
+        kind = node[0]
+        if kind == 'sym':
+            start = self.new_state()
+            end = self.new_state()
+            for sym in node[1]:
+                self._add_edges(start, sym, (end,))
+            return start, end
+
+        if kind == 'cat':
+            if not node[1]:
+                start = self.new_state()
+                return start, start
+            start, end = self._emit_regex(node[1][0])
+            for item in node[1][1:]:
+                item_start, item_end = self._emit_regex(item)
+                self._add_edges(end, Epsilon, (item_start,))
+                end = item_end
+            return start, end
+
+        if kind == 'alt':
+            start = self.new_state()
+            end = self.new_state()
+            for branch in node[1]:
+                branch_start, branch_end = self._emit_regex(branch)
+                self._add_edges(start, Epsilon, (branch_start,))
+                self._add_edges(branch_end, Epsilon, (end,))
+            return start, end
+
+        _, item, m, n = node
+        # Mandatory copies, then either a loop or the optional copies
+        start = end = self.new_state()
+        for _ in range(m):
+            item_start, item_end = self._emit_regex(item)
+            self._add_edges(end, Epsilon, (item_start,))
+            end = item_end
+
+        if n is None:
+            item_start, item_end = self._emit_regex(item)
+            loop_end = self.new_state()
+            self._add_edges(end, Epsilon, (item_start, loop_end))
+            self._add_edges(item_end, Epsilon, (item_start, loop_end))
+            return start, loop_end
+
+        optional_end = self.new_state()
+        self._add_edges(end, Epsilon, (optional_end,))
+        for _ in range(n - m):
+            item_start, item_end = self._emit_regex(item)
+            self._add_edges(end, Epsilon, (item_start,))
+            self._add_edges(item_end, Epsilon, (optional_end,))
+            end = item_end
+        return start, optional_end
+
+    def save(self, path):
+        """
+        Save this NFA to a compact binary file.
+
+        The file holds the alphabet, state ids and names, initial and final
+        states, tags, the edges of each state as flat arrays and the pattern
+        order of a tagged_union. Symbols,
+        names and tags may be int, str, bytes or None.
+
+        :param path: File name to write
+        :return: None
+        """
+        symbols = _sorted_symbols(self._alphabet - {Epsilon}) + [Epsilon]
+        index = {sym: i for i, sym in enumerate(symbols)}
+        states = sorted(self._states)
+
+        offsets = [0]
+        edge_symbols = []
+        edge_targets = []
+        for p in states:
+            for sym, targets in self._states[p].items():
+                for q in sorted(targets):
+                    edge_symbols.append(index[sym])
+                    edge_targets.append(q)
+            offsets.append(len(edge_targets))
+
+        tagged = sorted(self._tags)
+        parts = [
+            b'PNFA', struct.pack('<H?ii', _FORMAT_VERSION, self._sparse,
+                                 -1 if self._initial is None else self._initial, self._next_state),
+            _pack_values(symbols),
+            _pack_ints(states),
+            _pack_values([self._state_names[p] for p in states]),
+            _pack_ints(sorted(self._finals)),
+            _pack_ints(tagged),
+        ]
+        parts += [_pack_values(_sorted_symbols(self._tags[p])) for p in tagged]
+        parts += [_pack_ints(offsets), _pack_ints(edge_symbols), _pack_ints(edge_targets)]
+        parts.append(_pack_values(sorted(self._tag_order, key=self._tag_order.get)))
+
+        with open(path, 'wb') as f:
+            f.write(b''.join(parts))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an NFA saved by NFA.save
+
+        :param path: File name to read
+        :return: new NFA instance
+        """
+        with open(path, 'rb') as f:
+            buf = f.read()
+
+        offset = _check_header(buf, b'PNFA')
+        sparse, initial, next_state = struct.unpack_from('<?ii', buf, offset)
+        offset += struct.calcsize('<?ii')
+        symbols, offset = _unpack_values(buf, offset)
+        states, offset = _unpack_ints(buf, offset)
+        names, offset = _unpack_values(buf, offset)
+        finals, offset = _unpack_ints(buf, offset)
+        tagged, offset = _unpack_ints(buf, offset)
+        tags = []
+        for _ in tagged:
+            values, offset = _unpack_values(buf, offset)
+            tags.append(values)
+        offsets, offset = _unpack_ints(buf, offset)
+        edge_symbols, offset = _unpack_ints(buf, offset)
+        edge_targets, offset = _unpack_ints(buf, offset)
+        # Files written before the pattern order was saved end here
+        tag_order = _unpack_values(buf, offset)[0] if offset < len(buf) else []
+
+        nfa = cls(symbols, sparse=sparse)
+        for i, p in enumerate(states):
+            edges = {} if sparse else {s: set() for s in nfa._alphabet}
+            for e in range(offsets[i], offsets[i + 1]):
+                sym = symbols[edge_symbols[e]]
+                if sym not in edges:
+                    edges[sym] = set()
+                edges[sym].add(edge_targets[e])
+            nfa._states[p] = edges
+            nfa._state_names[p] = names[i]
+        nfa._finals = set(finals)
+        nfa._tags = {p: set(t) for p, t in zip(tagged, tags)}
+        nfa._tag_order = {tag: i for i, tag in enumerate(tag_order)}
+        nfa._initial = None if initial < 0 else initial
+        nfa._next_state = next_state
+        return nfa
+
+
+class Matcher(object):
+    """
+    Incremental matcher holding the current state set of an NFA.
+
+    Input is pushed with feed() as it arrives, e.g. from a socket or a file,
+    and the result can be queried at any point. States from which no final
+    state can be reached are dropped from the state set, so is_dead() is True
+    as soon as no continuation of the input can be accepted, and feed() then
+    stops consuming input.
+
+    The matcher uses the NFA as it was when the matcher was created.
+
+    Example:
+       matcher = nfa.matcher()
+       for chunk in iter(lambda: f.read(4096), ''):
+           if not matcher.feed(chunk):
+               break
+       matcher.is_accepting()
+    """
+
+    def __init__(self, nfa):
+        """
+        :param nfa: NFA to match input against
+        :return: None
+        """
+        if nfa.get_initial() is None:
+            raise NFAException("NFA has no initial state")
+
+        self._tables = nfa._bitsets()
+        self._step = nfa._lazy().step if nfa._lazy_dfa_options is not None else self._tables.step
+        self._live = self._tables.to_mask(nfa.coreachable_states())
+        self.reset()
+
+    def reset(self):
+        """
+        Go back to the initial state set, to match a new input from its start
+        """
+        self._current = self._tables.initial & self._live
+        self._consumed = 0
+
+    @property
+    def consumed(self):
+        """Number of symbols consumed since the last reset"""
+        return self._consumed
+
+    def feed(self, chunk):
+        """
+        Consume a chunk of input symbols. Consuming stops early if the
+        matcher becomes dead.
+
+        :param chunk: Iterable of input symbols from the defined alphabet
+        :return: False if the matcher is dead, True if not
+        """
+        current = self._current
+        step = self._step
+        live = self._live
+        consumed = 0
+        for sym in chunk:
+            if not current:
+                break
+            current = step(current, sym) & live
+            consumed += 1
+
+        self._current = current
+        self._consumed += consumed
+        return current != 0
+
+    def is_accepting(self):
+        """
+        :return: True if the input consumed so far is accepted
+        """
+        return True if self._current & self._tables.finals else False
+
+    def is_dead(self):
+        """
+        :return: True if no continuation of the input consumed so far can be accepted
+        """
+        return not self._current
+
+    def accepting_tags(self):
+        """
+        :return: Set of tags of the final states the matcher is in, with None for untagged ones
+        """
+        return self._tables.tags_of(self._current)
+
+    def get_states(self):
+        """
+        :return: Set of the current state ids
+        """
+        return self._tables.to_set(self._current)
+
+
+class CompiledDFA(object):
+    """
+    Matcher for a deterministic automaton using a flat transition table.
+
+    States are renumbered densely from 0 and every symbol class of the DFA
+    (see NFA.symbol_classes) is given a column, shared by all symbols in the
+    class. The next state from state p over a symbol in column c is found
+    at index p * no_of_columns + c of an array('i'). States from which no
+    final state can be reached are dropped and their transitions are stored
+    as -1, so matching stops as soon as the input can no longer be accepted.
+
+    Example:
+       matcher = nfa.compile_dfa()
+       matcher.accepts('abcde')
+    """
+
+    def __init__(self, dfa):
+        """
+        :param dfa: Deterministic NFA instance, e.g. from NFA.subset_construct_dfa()
+        :return: None
+        """
+        if dfa.get_initial() is None:
+            raise NFAException("NFA has no initial state")
+        if not dfa.is_deterministic():
+            raise NFAException("NFA is not deterministic")
+
+        class_of, classes = dfa._classes()
+        self._columns = dict(class_of)
+        self._no_of_columns = len(classes)
+
+        # Keep only states that can reach a final state
+        live = dfa.coreachable_states()
+        self._state_map = {p: sid for sid, p in enumerate(sorted(live))}
+        self._initial = self._state_map.get(dfa.get_initial(), -1)
+        self._finals = bytearray(len(live))
+        self._tags = {}  # {state:frozenset(tags)}
+        self._table = array('i', [-1]) * (len(live) * self._no_of_columns)
+        for p, sid in self._state_map.items():
+            if p in dfa._finals:
+                self._finals[sid] = 1
+                self._tags[sid] = frozenset(dfa._tags.get(p, _UNTAGGED))
+            base = sid * self._no_of_columns
+            for s, states in dfa._states[p].items():
+                for q in states:
+                    if q in live:
+                        self._table[base + self._columns[s]] = self._state_map[q]
+        self._numpy_cache = None  # (table, finals, lookup), built on demand by accepts_batch
+
+    @property
+    def no_of_states(self):
+        return len(self._finals)
+
+    @property
+    def no_of_columns(self):
+        return self._no_of_columns
+
+    def get_state_map(self):
+        """
+        Get the mapping from state ids of the source DFA to state ids of this matcher.
+        States that were dropped since they can not reach a final state are not included.
+
+        :return: Dict of format {dfa_state: compiled_state, ...}
+        """
+        return dict(self._state_map)
+
+    def accepts(self, input_sequence):
+        """
+        Run the DFA on an input sequence of symbols and return
+        True if the whole sequence is consumed and the DFA is in
+        a final state
+
+        :param input_sequence: Iterable of input symbols from the defined alphabet
+        :returns: True if the DFA accepts input, False if not
+        """
+        state = self._run(input_sequence)
+        return state >= 0 and self._finals[state] == 1
+
+    def matching_tags(self, input_sequence):
+        """
+        Run the DFA on an input sequence of symbols and return the tags
+        of the final state it ends in.
+
+        :param input_sequence: Iterable of input symbols from the defined alphabet
+        :return: Set of tags, with None for untagged finals. Empty if the input is rejected.
+        """
+        state = self._run(input_sequence)
+        return set(self._tags.get(state, ()))
+
+    def accepts_batch(self, input_sequences):
+        """
+        Run the DFA on each of a number of input sequences at once, using NumPy.
+
+        All inputs are advanced together one position at a time, with the
+        next states of the whole batch looked up in one indexing operation
+        on the transition table. This pays off for large batches of short
+        inputs, where the per input overhead of accepts dominates. Inputs
+        shorter than the longest one are padded with a column that keeps
+        every state unchanged. A batch of strings over single character
+        symbols is converted to columns without a Python loop over its
+        characters.
+
+        Unlike accepts, every symbol of every input is checked, so a symbol
+        outside the alphabet throws NFAInvalidInput even if the input would
+        have been rejected before reaching it.
+
+        Example:
+           matcher = nfa.compile_dfa()
+           matcher.accepts_batch(['ab', 'abc', ''])  -> array([ True, False, False])
+
+        Throws NFAException if NumPy is not installed.
+
+        :param input_sequences: Iterable of input sequences
+        :return: numpy array of bool, True for each accepted input
+        """
+        if numpy is None:
+            raise NFAException("accepts_batch requires numpy")
+
+        input_sequences = list(input_sequences)
+        table, finals, lookup = self._numpy_tables()
+        width = max([len(seq) for seq in input_sequences] or [0])
+        columns = self._batch_columns(input_sequences, width, lookup)
+
+        dead = self.no_of_states
+        states = numpy.full(len(input_sequences), dead if self._initial < 0 else self._initial, dtype=numpy.intp)
+        flat = table.ravel()
+        stride = table.shape[1]
+        for i in range(width):
+            states = flat.take(states * stride + columns[i])
+        return finals[states]
+
+    def _numpy_tables(self):
+        """
+        Get the transition table, finals and character lookup as NumPy arrays,
+        building them first if needed.
+
+        The table has an extra dead state row, that rejected inputs are moved
+        to instead of -1, and an extra padding column mapping each state to itself.
+        The lookup maps code points to columns, with -1 for code points that are
+        not symbols, including all above the highest symbol. It is None if some
+        symbol is not a single character.
+
+        :return: Tuple (2D array of next states, bool array of final states including the dead state, lookup)
+        """
+        tables = self._numpy_cache
+        if tables is None:
+            no_of_states = self.no_of_states
+            dead = no_of_states
+            flat = numpy.asarray(self._table, dtype=numpy.intp).reshape(no_of_states, self._no_of_columns)
+            table = numpy.empty((no_of_states + 1, self._no_of_columns + 1), dtype=numpy.intp)
+            table[:no_of_states, :self._no_of_columns] = numpy.where(flat < 0, dead, flat)
+            table[dead, :] = dead
+            table[:, self._no_of_columns] = numpy.arange(no_of_states + 1)
+            finals = numpy.zeros(no_of_states + 1, dtype=bool)
+            finals[:no_of_states] = numpy.frombuffer(bytes(self._finals), dtype=numpy.uint8) == 1
+
+            lookup = None
+            if all(isinstance(sym, str) and len(sym) == 1 for sym in self._columns):
+                lookup = numpy.full(max([ord(sym) for sym in self._columns] or [0]) + 2, -1, dtype=numpy.intp)
+                for sym, c in self._columns.items():
+                    lookup[ord(sym)] = c
+            tables = self._numpy_cache = (table, finals, lookup)
+
+        return tables
+
+    def _batch_columns(self, input_sequences, width, lookup):
+        """
+        :return: 2D array with the columns of the symbols at each position of all inputs,
+                 one row per position, padded with the padding column
+        """
+        columns = numpy.full((width, len(input_sequences)), self._no_of_columns, dtype=numpy.intp)
+        if lookup is not None and all(isinstance(seq, str) for seq in input_sequences):
+            # Look up all characters of the batch at once and scatter them to their positions
+            text = ''.join(input_sequences)
+            codes = numpy.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+            flat = lookup[numpy.minimum(codes, len(lookup) - 1)]
+            if (flat < 0).any():
+                sym = text[int(numpy.argmax(flat < 0))]
+                raise NFAInvalidInput("symbol {} not in the defined alphabet".format(sym))
+            lengths = numpy.fromiter((len(seq) for seq in input_sequences), dtype=numpy.intp,
+                                     count=len(input_sequences))
+            starts = numpy.cumsum(lengths) - lengths
+            inputs = numpy.repeat(numpy.arange(len(input_sequences)), lengths)
+            columns[numpy.arange(len(flat)) - starts[inputs], inputs] = flat
+            return columns
+
+        for i, seq in enumerate(input_sequences):
+            try:
+                columns[:len(seq), i] = [self._columns[sym] for sym in seq]
+            except KeyError as e:
+                raise NFAInvalidInput("symbol {} not in the defined alphabet".format(e.args[0]))
+        return columns
+
+    def _run(self, input_sequence):
+        """
+        :return: State reached after consuming the input sequence, or -1 if the input was rejected early
+        """
+        state = self._initial
+        if state < 0:
+            return state
+
+        table = self._table
+        columns = self._columns
+        width = self._no_of_columns
+        for sym in input_sequence:
+            try:
+                state = table[state * width + columns[sym]]
+            except KeyError:
+                raise NFAInvalidInput("symbol {} not in the defined alphabet".format(sym))
+            if state < 0:
+                return state
+
+        return state
+
+    def save(self, path):
+        """
+        Save this DFA to a binary file that CompiledDFA.load maps into memory.
+
+        The transition table is stored as raw 32 bit ints in the byte order
+        of this machine, aligned so it can be used in place after loading.
+
+        :param path: File name to write
+        :return: None
+        """
+        symbols = _sorted_symbols(self._columns)
+        tagged = sorted(self._tags)
+        parts = [
+            _pack_values(symbols),
+            _pack_ints([self._columns[sym] for sym in symbols]),
+            _pack_ints(tagged),
+        ]
+        parts += [_pack_values(_sorted_symbols(self._tags[p])) for p in tagged]
+        parts.append(bytes(self._finals))
+        body = b''.join(parts)
+
+        header_format = '<H?iiiI'
+        header_size = 4 + struct.calcsize(header_format)
+        table_offset = header_size + len(body)
+        padding = -table_offset % 8
+        table_offset += padding
+
+        with open(path, 'wb') as f:
+            f.write(b'PDFA')
+            f.write(struct.pack(header_format, _FORMAT_VERSION, sys.byteorder == 'big',
+                                self.no_of_states, self._no_of_columns, self._initial, table_offset))
+            f.write(body)
+            f.write(b'\0' * padding)
+            f.write(self._table.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a DFA saved by CompiledDFA.save.
+
+        The file is mapped read only into memory, and the transition table
+        and final states are used directly from the mapping without being
+        copied. Processes loading the same file share one copy of the table.
+
+        :param path: File name to read
+        :return: new CompiledDFA instance
+        """
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = _check_header(buf, b'PDFA')
+        big_endian, no_of_states, no_of_columns, initial, table_offset = \
+            struct.unpack_from('<?iiiI', buf, offset)
+        offset += struct.calcsize('<?iiiI')
+        symbols, offset = _unpack_values(buf, offset)
+        columns, offset = _unpack_ints(buf, offset)
+        tagged, offset = _unpack_ints(buf, offset)
+        tags = {}
+        for p in tagged:
+            values, offset = _unpack_values(buf, offset)
+            tags[p] = frozenset(values)
+
+        dfa = cls.__new__(cls)
+        dfa._columns = dict(zip(symbols, columns))
+        dfa._no_of_columns = no_of_columns
+        dfa._initial = initial
+        dfa._tags = tags
+        dfa._state_map = {}
+        dfa._numpy_cache = None
+        dfa._finals = memoryview(buf)[offset:offset + no_of_states]
+
+        table = memoryview(buf)[table_offset:table_offset + 4 * no_of_states * no_of_columns]
+        if big_endian == (sys.byteorder == 'big') and array('i').itemsize == 4:
+            dfa._table = table.cast('i')
+        else:
+            # Saved on a machine with another int layout, use a converted copy
+            dfa._table = array('i', struct.unpack('{}{}i'.format('>' if big_endian else '<', len(table) // 4), table))
+        return dfa
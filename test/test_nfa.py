@@ -18,9 +18,21 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import itertools
+import os
+import re
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 
-from nfa import NFA, Epsilon, NFAException
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import nfa as nfa_module
+from nfa import NFA, CheckResult, CompiledDFA, Matcher, MatchStats, Epsilon, NFAException, NFAInvalidInput, NFASyntaxError, compile_regex
 
 
 class TestSimpleDFA(unittest.TestCase):
@@ -386,6 +398,68 @@ class TestCombinations(unittest.TestCase):
         self.assertFalse(fstar.test_input('10'), 'String "10" not rejected')
 
 
+class TestNaryCombinations(unittest.TestCase):
+    """Test single pass composition of many NFAs"""
+
+    def setUp(self):
+        self.words = []
+        for word in ['0', '01', '110']:
+            nfa = NFA('01')
+            nfa.build_from_string(word)
+            self.words.append(nfa)
+
+    def test_concat_all(self):
+        fa = NFA.concat_all(self.words)
+        chained = self.words[0] | self.words[1] | self.words[2]
+        self.assertEqual(fa.no_of_states, chained.no_of_states)
+        self.assertTrue(fa.test_input('001110'), 'String "001110" not accepted')
+        self.assertFalse(fa.test_input('00111'), 'String "00111" not rejected')
+        self.assertFalse(fa.test_input('0110'), 'String "0110" not rejected')
+
+    def test_union_all(self):
+        fa = NFA.union_all(self.words)
+        for v in ['0', '01', '110']:
+            self.assertTrue(fa.test_input(v), 'String "{}" not accepted'.format(v))
+        for v in ['', '1', '011', '0110']:
+            self.assertFalse(fa.test_input(v), 'String "{}" not rejected'.format(v))
+
+    def test_star_inplace(self):
+        fa = NFA.union_all(self.words)
+        n = fa.no_of_states
+        self.assertIs(fa.star_inplace(), fa)
+        self.assertEqual(fa.no_of_states, n + 2)
+        for v in ['', '0', '0110', '1100010']:
+            self.assertTrue(fa.test_input(v), 'String "{}" not accepted'.format(v))
+        for v in ['1', '0111']:
+            self.assertFalse(fa.test_input(v), 'String "{}" not rejected'.format(v))
+
+    def test_star_with_id_gaps(self):
+        """star() on an NFA whose state ids do not start at 0 or have holes"""
+        fa = NFA('ab')
+        hole = fa.new_state()
+        fa.build_from_string('ab')
+        fa.del_state(hole)
+        starred = fa.star()
+        for v in ['', 'ab', 'abab']:
+            self.assertTrue(starred.test_input(v), 'String "{}" not accepted'.format(v))
+        for v in ['a', 'b', 'aba']:
+            self.assertFalse(starred.test_input(v), 'String "{}" not rejected'.format(v))
+
+    def test_many(self):
+        """Composing thousands of parts"""
+        parts = [self.words[i % 3] for i in range(3000)]
+        fa = NFA.union_all(parts)
+        self.assertEqual(fa.no_of_states, sum(p.no_of_states for p in parts) + 2)
+        self.assertTrue(fa.test_input('110'))
+        fa = NFA.concat_all(parts[:300])
+        self.assertTrue(fa.test_input('001110' * 100))
+
+    def test_operands(self):
+        self.assertRaises(NFAException, NFA.union_all, [])
+        self.assertRaises(NFAException, NFA.concat_all, [self.words[0], NFA('01')])
+        self.assertRaises(NFAException, NFA('01').star_inplace)
+
+
 class TestClosure(unittest.TestCase):
     def testClosure(self):
         nfa = NFA('01')
@@ -418,6 +492,45 @@ class TestClosure(unittest.TestCase):
         closure = nfa.closure(s0)
         self.assertIn(s0, closure, "Closure start state should be in closure")
 
+    def testClosureUpdatedByEdges(self):
+        """Cached closures must follow edges added and states deleted later"""
+        nfa = NFA('01')
+
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state()
+        s2 = nfa.new_state(final=True)
+        nfa.new_edge(s0, Epsilon, s1)
+        self.assertEqual(nfa.closure(s0), {s0, s1})
+
+        nfa.new_edge(s1, Epsilon, s2)
+        self.assertEqual(nfa.closure(s0), {s0, s1, s2})
+        self.assertEqual(nfa.closure({s1, s2}), {s1, s2})
+        self.assertEqual(nfa.move({s0}, '0'), set())
+
+        nfa.add_multiple_edges(s2, {'0': s0})
+        self.assertEqual(nfa.move({s0}, '0'), {s0, s1, s2})
+
+        nfa.del_state(s1)
+        self.assertEqual(nfa.closure(s0), {s0})
+        self.assertEqual(nfa.move({s2}, '0'), {s0})
+
+    def testCyclicClosure(self):
+        nfa = NFA('01')
+
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state()
+        s2 = nfa.new_state()
+        s3 = nfa.new_state(final=True)
+        nfa.new_edge(s0, Epsilon, s1)
+        nfa.new_edge(s1, Epsilon, s2)
+        nfa.new_edge(s2, Epsilon, s0)
+        nfa.new_edge(s2, Epsilon, s3)
+
+        for p in (s0, s1, s2):
+            self.assertEqual(nfa.closure(p), {s0, s1, s2, s3})
+        self.assertEqual(nfa.closure(s3), {s3})
+
+
 class TestAlphaNumericDFA(unittest.TestCase):
     """Test NFA->DFA conversion"""
 
@@ -491,6 +604,111 @@ class TestAlphaNumericDFA(unittest.TestCase):
             self.assertFalse(dfa.test_input(v), 'String "{}" was not rejected by dfa as it should'.format(v))
 
 
+class TestSubsetConstruction(unittest.TestCase):
+    """Test subset construction on NFAs with more structure"""
+
+    def test_initial_final(self):
+        """A DFA for a starred NFA must accept the empty string"""
+        nfa = NFA('01')
+        nfa.build_from_string('01')
+        dfa = nfa.star().subset_construct_dfa()
+        self.assertTrue(dfa.test_input(''), 'String "" not accepted')
+        self.assertTrue(dfa.test_input('0101'), 'String "0101" not accepted')
+        self.assertFalse(dfa.test_input('010'), 'String "010" not rejected')
+
+    def test_blowup(self):
+        """(0|1)*0(0|1)^n needs 2^(n+1) DFA states"""
+        n = 6
+        nfa = NFA('01')
+        s0 = nfa.new_state(initial=True)
+        nfa.add_multiple_edges(s0, {'0': s0, '1': s0})
+        prev = nfa.new_state()
+        nfa.new_edge(s0, '0', prev)
+        for i in range(n):
+            sid = nfa.new_state(final=(i == n - 1))
+            nfa.add_multiple_edges(prev, {'0': sid, '1': sid})
+            prev = sid
+
+        dfa = nfa.subset_construct_dfa()
+        self.assertTrue(dfa.is_deterministic())
+        self.assertEqual(dfa.no_of_states, 2 ** (n + 1))
+        for i in range(2 ** (n + 2)):
+            v = format(i, 'b')
+            self.assertEqual(dfa.test_input(v), nfa.test_input(v), 'Mismatch on "{}"'.format(v))
+
+    def test_stable_names(self):
+        nfa = NFA('01')
+        nfa.build_from_string('0110')
+        nfa = nfa.star() + nfa
+        first = nfa.subset_construct_dfa().get_states()
+        self.assertEqual(nfa.subset_construct_dfa().get_states(), first)
+
+
+class TestMinimize(unittest.TestCase):
+    """Test DFA minimization"""
+
+    def assertSameLanguage(self, fa1, fa2, length=6, alphabet='01'):
+        for n in range(length + 1):
+            for i in range(len(alphabet) ** n):
+                v = ''
+                for _ in range(n):
+                    i, r = divmod(i, len(alphabet))
+                    v += alphabet[r]
+                self.assertEqual(fa1.test_input(v), fa2.test_input(v), 'Mismatch on "{}"'.format(v))
+
+    def test_composed(self):
+        """(01)* built from composed NFAs has a 3 state minimal complete DFA"""
+        nfa = NFA('01')
+        nfa.build_from_string('01')
+        nfa = (nfa + nfa).star() | nfa.star()
+        dfa = nfa.subset_construct_dfa()
+        mdfa, state_map = dfa.minimize()
+
+        self.assertTrue(mdfa.is_deterministic())
+        self.assertEqual(mdfa.no_of_states, 3)
+        self.assertLess(mdfa.no_of_states, dfa.no_of_states)
+        self.assertEqual(set(state_map), set(dfa.get_states()))
+        self.assertEqual(state_map[dfa.get_initial()], mdfa.get_initial())
+        self.assertSameLanguage(mdfa, nfa)
+
+        # Minimizing again changes nothing
+        mdfa2, state_map2 = mdfa.minimize()
+        self.assertEqual(mdfa2.no_of_states, 3)
+        self.assertEqual(state_map2, {p: p for p in mdfa.get_states()})
+
+    def test_partial(self):
+        """Missing transitions go to an implicit dead state that is not added"""
+        dfa = NFA('01')
+        s0 = dfa.new_state(initial=True)
+        s1 = dfa.new_state(final=True)
+        s2 = dfa.new_state(final=True)
+        s3 = dfa.new_state()
+        dfa.new_edge(s0, '0', s1)
+        dfa.new_edge(s0, '1', s2)
+        dfa.new_edge(s1, '0', s1)
+        dfa.new_edge(s2, '0', s2)
+
+        mdfa, state_map = dfa.minimize()
+        self.assertEqual(mdfa.no_of_states, 2)
+        self.assertEqual(state_map[s1], state_map[s2])
+        self.assertNotIn(s3, state_map)
+        self.assertSameLanguage(mdfa, dfa)
+
+    def test_compiled(self):
+        nfa = NFA('01')
+        nfa.build_from_string('0')
+        nfa = (nfa + nfa + nfa).star()
+        matcher = nfa.compile_dfa(minimize=True)
+        self.assertEqual(matcher.no_of_states, 1)
+        self.assertTrue(matcher.accepts('000'))
+        self.assertFalse(matcher.accepts('001'))
+
+    def test_requires_dfa(self):
+        nfa = NFA('01')
+        nfa.build_from_string('01')
+        self.assertRaises(NFAException, nfa.minimize)
+
+
 class TestStringNFA(unittest.TestCase):
     """Test construction of NFA from a simple string of symbols"""
 
@@ -509,5 +727,1070 @@ class TestStringNFA(unittest.TestCase):
         self.assertFalse(nfa.test_input('abcdef'), 'String "abcdef" was not rejected as it should')
         self.assertFalse(nfa.test_input(''), 'String "" was not rejected as it should')
 
+
+class TestBitsetMatching(unittest.TestCase):
+    """Test that bitmask based matching agrees with set based simulation"""
+
+    def simulate(self, nfa, v):
+        current = nfa.closure({nfa.get_initial()})
+        for sym in v:
+            current = nfa.move(current, sym)
+        return bool(current & set(nfa.get_finals()))
+
+    def testAgreesWithMove(self):
+        nfa = NFA('01')
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state()
+        s2 = nfa.new_state()
+        s3 = nfa.new_state(final=True)
+        nfa.new_edge(s0, '0', s0)
+        nfa.new_edge(s0, '1', s0)
+        nfa.new_edge(s0, '1', s1)
+        nfa.new_edge(s1, Epsilon, s2)
+        nfa.new_edge(s2, '0', s3)
+        nfa.new_edge(s2, '1', s3)
+
+        for n in range(6):
+            for i in range(2 ** n):
+                v = format(i, 'b').zfill(n) if n else ''
+                self.assertEqual(nfa.test_input(v), self.simulate(nfa, v), 'Mismatch on "{}"'.format(v))
+
+    def testSparseStateIds(self):
+        """Deleted states leave holes in the state ids"""
+        nfa = NFA('01')
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state()
+        s2 = nfa.new_state()
+        s3 = nfa.new_state(final=True)
+        nfa.new_edge(s0, '0', s1)
+        nfa.new_edge(s0, '1', s2)
+        nfa.new_edge(s1, '0', s3)
+        nfa.new_edge(s2, '1', s3)
+        self.assertTrue(nfa.test_input('11'))
+
+        nfa.del_state(s2)
+        self.assertFalse(nfa.test_input('11'))
+        self.assertTrue(nfa.test_input('00'))
+
+        nfa.remove_final_state(s3)
+        self.assertFalse(nfa.test_input('00'))
+        nfa.set_as_final_state(s1)
+        self.assertTrue(nfa.test_input('0'))
+
+
+    def testLargeNFAStepsSets(self):
+        """NFAs above the state limit match without building the bitmask tables"""
+        nfa = compile_regex('(0|1)*1(0|1)', '01')
+        vectors = ['', '1', '10', '011', '0100', '111']
+        expected = [nfa.test_input(v) for v in vectors]
+
+        large = compile_regex('(0|1)*1(0|1)', '01')
+        stats = large.enable_stats()
+        with mock.patch.object(nfa_module, '_BITSET_MAX_STATES', 2):
+            self.assertEqual([large.test_input(v) for v in vectors], expected)
+            self.assertEqual(list(large.match_many(vectors)), expected)
+            self.assertRaises(NFAInvalidInput, large.test_input, '012')
+        self.assertIsNone(large._bitset_tables)
+        self.assertEqual(stats.counters['inputs'], 2 * len(vectors))
+
+
+class TestBatchMatching(unittest.TestCase):
+    """Test matching many inputs in one call"""
+
+    def setUp(self):
+        nfa = NFA('01')
+        nfa.build_from_string('01')
+        self.nfa = nfa.star()
+        self.vectors = ['', '01', '0101', '010', '1', '00', '0110', '010101']
+        self.expected = [self.nfa.test_input(v) for v in self.vectors]
+
+    def test_match_many(self):
+        results = self.nfa.match_many(iter(self.vectors))
+        self.assertEqual(list(results), self.expected)
+
+    def test_test_inputs(self):
+        results = self.nfa.test_inputs(self.vectors)
+        self.assertEqual(results.typecode, 'B')
+        self.assertEqual([bool(r) for r in results], self.expected)
+
+        self.nfa.enable_lazy_dfa(cache_size=4)
+        self.assertEqual([bool(r) for r in self.nfa.test_inputs(self.vectors)], self.expected)
+
+    def test_errors(self):
+        self.assertRaises(NFAInvalidInput, self.nfa.test_inputs, ['01', '2'])
+        self.assertRaises(NFAException, NFA('01').match_many, ['01'])
+
+    def test_parallel(self):
+        vectors = self.vectors * 50
+        results = self.nfa.match_many_parallel(iter(vectors), workers=2, chunk_size=7)
+        self.assertEqual(list(results), self.expected * 50)
+
+        self.nfa.enable_lazy_dfa(cache_size=16)
+        results = self.nfa.match_many_parallel(vectors, workers=2, chunk_size=100)
+        self.assertEqual(list(results), self.expected * 50)
+
+        results = self.nfa.match_many_parallel(['01', '2'], workers=1)
+        self.assertRaises(NFAInvalidInput, list, results)
+
+
+class TestMatcher(unittest.TestCase):
+    """Test matching input chunk by chunk"""
+
+    def setUp(self):
+        nfa = NFA('abc')
+        nfa.build_from_string('ab')
+        self.nfa = nfa.star()
+
+    def test_chunks(self):
+        matcher = self.nfa.matcher()
+        self.assertTrue(matcher.is_accepting())
+        self.assertTrue(matcher.feed('aba'))
+        self.assertFalse(matcher.is_accepting())
+        self.assertTrue(matcher.feed(''))
+        self.assertTrue(matcher.feed(iter('ba')))
+        self.assertTrue(matcher.feed('b'))
+        self.assertTrue(matcher.is_accepting())
+        self.assertEqual(matcher.consumed, 6)
+        self.assertFalse(matcher.is_dead())
+
+    def test_dead(self):
+        matcher = Matcher(self.nfa)
+        self.assertFalse(matcher.feed('abb' + 'ab' * 10))
+        self.assertTrue(matcher.is_dead())
+        self.assertFalse(matcher.is_accepting())
+        self.assertEqual(matcher.consumed, 3, 'Input consumed after matcher died')
+        self.assertEqual(matcher.get_states(), set())
+
+        matcher.reset()
+        self.assertEqual(matcher.consumed, 0)
+        self.assertTrue(matcher.feed('ab'))
+        self.assertTrue(matcher.is_accepting())
+
+    def test_dead_before_empty(self):
+        """States that can not reach a final state do not keep the matcher alive"""
+        nfa = NFA('ab')
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state(final=True)
+        s2 = nfa.new_state()
+        nfa.new_edge(s0, 'a', s1)
+        nfa.new_edge(s0, 'b', s2)
+        nfa.new_edge(s2, 'a', s2)
+        nfa.new_edge(s2, 'b', s2)
+
+        matcher = nfa.matcher()
+        self.assertFalse(matcher.feed('baaa'))
+        self.assertEqual(matcher.consumed, 1)
+
+    def test_lazy(self):
+        self.nfa.enable_lazy_dfa(cache_size=8)
+        matcher = self.nfa.matcher()
+        for _ in range(5):
+            self.assertTrue(matcher.feed('ab'))
+        self.assertTrue(matcher.is_accepting())
+        self.assertRaises(NFAInvalidInput, matcher.feed, 'd')
+
+
+class TestSearch(unittest.TestCase):
+    """Test finding matches inside longer texts"""
+
+    def brute_force(self, nfa, text, overlapped):
+        """Reference results by testing every substring"""
+        def accepts(v):
+            return all(c in 'ab' for c in v) and nfa.test_input(v)
+
+        if overlapped:
+            spans = []
+            for j in range(len(text) + 1):
+                starts = [i for i in range(j + 1) if accepts(text[i:j])]
+                if starts:
+                    spans.append((starts[0], j))
+            return spans
+
+        spans = []
+        pos = 0
+        while pos <= len(text):
+            found = [(i, j) for i in range(pos, len(text) + 1) for j in range(i, len(text) + 1)
+                     if accepts(text[i:j])]
+            if not found:
+                break
+            i = min(found)[0]
+            j = max(e for s, e in found if s == i)
+            spans.append((i, j))
+            pos = j if j > i else j + 1
+        return spans
+
+    def nfas(self):
+        ab = NFA('ab')
+        ab.build_from_string('ab')
+        a = NFA('ab')
+        a.build_from_string('a')
+        b = NFA('ab')
+        b.build_from_string('b')
+        yield ab
+        yield a | b.star()
+        yield (a + b).star()
+        yield a.star() | ab | b
+
+    def test_against_brute_force(self):
+        texts = ['', 'ab', 'xabyab', 'aabab', 'bbaab', 'abxaabbb', 'aaaa', 'babab']
+        for nfa in self.nfas():
+            for text in texts:
+                for mode, overlapped in (('leftmost-longest', False), ('all', True)):
+                    self.assertEqual(list(nfa.finditer(text, mode)), self.brute_force(nfa, text, overlapped),
+                                     'Mismatch on "{}" in mode {}'.format(text, mode))
+
+    def test_all_mode_reads_once(self):
+        """'all' mode reads each symbol exactly once, also where leftmost-longest reads ahead"""
+        class CountingText(object):
+            def __init__(self, text):
+                self.text = text
+                self.reads = 0
+
+            def __len__(self):
+                return len(self.text)
+
+            def __getitem__(self, i):
+                self.reads += 1
+                return self.text[i]
+
+        nfa = compile_regex('a|a*b', 'ab')
+        for text in ['a' * 500, 'ab' * 250, 'a' * 499 + 'b']:
+            counting = CountingText(text)
+            spans = list(nfa.finditer(counting, 'all'))
+            self.assertEqual(counting.reads, len(text))
+            self.assertEqual([end for _, end in spans], list(range(1, len(text) + 1)))
+
+    def test_leftmost_longest_reads_ahead_once(self):
+        """Read ahead past a match that found no longer match is not repeated for later matches"""
+        class CountingText(object):
+            def __init__(self, text):
+                self.text = text
+                self.reads = 0
+
+            def __len__(self):
+                return len(self.text)
+
+            def __getitem__(self, i):
+                self.reads += 1
+                return self.text[i]
+
+        nfa = compile_regex('a|a*b', 'ab')
+        counting = CountingText('a' * 1000)
+        self.assertEqual(list(nfa.finditer(counting)), [(i, i + 1) for i in range(1000)])
+        self.assertLessEqual(counting.reads, 3 * 1000)
+        self.assertEqual(list(nfa.finditer('aab' + 'a' * 4 + 'b' + 'aa')), [(0, 3), (3, 8), (8, 9), (9, 10)])
+
+    def test_search(self):
+        nfa = NFA('ab')
+        nfa.build_from_string('ab')
+        self.assertEqual(list(nfa.finditer('xabyab')), [(1, 3), (4, 6)])
+        self.assertEqual(nfa.search('bbaabab'), (3, 5))
+        self.assertEqual(nfa.search(iter('bbaabab')), (3, 5))
+        self.assertEqual(nfa.search('bbaa'), None)
+        self.assertRaises(NFAException, nfa.finditer, 'ab', 'shortest')
+
+
+class TestTaggedUnion(unittest.TestCase):
+    """Test multi pattern NFAs reporting which patterns matched"""
+
+    def setUp(self):
+        alphabet = 'abc'
+        words = {'ab': 'ab', 'abc': 'abc', 'a_star': None}
+        patterns = {}
+        for tag, word in words.items():
+            nfa = NFA(alphabet)
+            if word is None:
+                nfa.build_from_string('a')
+                nfa = nfa.star()
+            else:
+                nfa.build_from_string(word)
+            patterns[tag] = nfa
+        self.patterns = patterns
+        self.nfa = NFA.tagged_union(patterns)
+        self.vectors = {
+            '': {'a_star'},
+            'a': {'a_star'},
+            'aaa': {'a_star'},
+            'ab': {'ab'},
+            'abc': {'abc'},
+            'abcc': set(),
+            'b': set(),
+        }
+
+    def test_tags(self):
+        nfa = self.nfa
+        for v, tags in self.vectors.items():
+            self.assertEqual(nfa.matching_tags(v), tags, 'Wrong tags for "{}"'.format(v))
+            self.assertEqual(nfa.test_input(v), bool(tags))
+            matcher = nfa.matcher()
+            matcher.feed(v)
+            self.assertEqual(matcher.accepting_tags(), tags)
+
+    def test_overlapping_patterns(self):
+        nfa = NFA.tagged_union([self.patterns['ab'], self.patterns['ab'], self.patterns['abc']])
+        self.assertEqual(nfa.matching_tags('ab'), {0, 1})
+        self.assertEqual(nfa.matching_tags('abc'), {2})
+
+    def test_untagged(self):
+        nfa = NFA('ab')
+        nfa.build_from_string('ab')
+        self.assertEqual(nfa.matching_tags('ab'), {None})
+        self.assertEqual(nfa.matching_tags('a'), set())
+        final = nfa.get_finals()[0]
+        nfa.set_as_final_state(final, 'word')
+        self.assertEqual(nfa.get_tags(final), {'word'})
+        self.assertEqual(nfa.matching_tags('ab'), {'word'})
+        nfa.remove_final_state(final)
+        self.assertEqual(nfa.get_tags(final), set())
+
+    def test_dfa(self):
+        dfa = self.nfa.subset_construct_dfa()
+        mdfa, _ = dfa.minimize()
+        matcher = self.nfa.compile_dfa(minimize=True)
+        for v, tags in self.vectors.items():
+            self.assertEqual(dfa.matching_tags(v), tags, 'Wrong DFA tags for "{}"'.format(v))
+            self.assertEqual(mdfa.matching_tags(v), tags, 'Wrong minimal DFA tags for "{}"'.format(v))
+            self.assertEqual(matcher.matching_tags(v), tags, 'Wrong compiled DFA tags for "{}"'.format(v))
+
+    def test_errors(self):
+        self.assertRaises(NFAException, NFA.tagged_union, [])
+        self.assertRaises(NFAException, NFA.tagged_union, [NFA('ab')])
+
+
+class TestRemoveEpsilons(unittest.TestCase):
+    """Test conversion to epsilon free NFAs"""
+
+    def test_equivalent(self):
+        for pattern in ['(ab|c)*', 'a?b?c?', '(a|b)*a(a|b)', 'a*', 'a{2,3}|c+']:
+            nfa = compile_regex(pattern, 'abc')
+            self.assertFalse(nfa.is_epsilon_free())
+            free = nfa.remove_epsilons()
+            self.assertTrue(free.is_epsilon_free())
+            self.assertEqual(free.get_edges_on_symbol(Epsilon), {})
+            self.assertEqual(free.get_states(), nfa.get_states())
+            for n in range(5):
+                for v in itertools.product('abc', repeat=n):
+                    self.assertEqual(free.test_input(v), nfa.test_input(v),
+                                     'Mismatch for pattern {!r} on "{}"'.format(pattern, ''.join(v)))
+
+    def test_fast_path(self):
+        nfa = NFA('01')
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state(final=True)
+        nfa.new_edge(s0, '0', s1)
+        nfa.new_edge(s0, '0', s0)
+        self.assertTrue(nfa.is_epsilon_free())
+        self.assertEqual(nfa.closure(s0), {s0})
+        self.assertEqual(nfa.move({s0}, '0'), {s0, s1})
+        self.assertTrue(nfa.test_input('000'))
+
+        nfa.new_edge(s1, Epsilon, s0)
+        self.assertFalse(nfa.is_epsilon_free())
+        self.assertEqual(nfa.closure(s1), {s0, s1})
+        self.assertEqual(nfa.move({s1}, '0'), {s0, s1})
+
+    def test_tags(self):
+        nfa = NFA.tagged_union({'ab': compile_regex('ab', 'abc'), 'abc': compile_regex('abc?', 'abc')})
+        free = nfa.remove_epsilons()
+        self.assertEqual(free.matching_tags('ab'), {'ab', 'abc'})
+        self.assertEqual(free.matching_tags('abc'), {'abc'})
+        self.assertEqual(free.matching_tags('a'), set())
+
+
+class TestSymbolClasses(unittest.TestCase):
+    """Test grouping of symbols no transition distinguishes"""
+
+    def test_classes(self):
+        nfa = compile_regex('[0-9]+x|y[0-4]', '0123456789xyz')
+        class_of, classes = nfa.symbol_classes()
+        self.assertEqual(sorted(sorted(c) for c in classes),
+                         [list('01234'), list('56789'), ['x'], ['y'], ['z']])
+        for c, members in enumerate(classes):
+            for sym in members:
+                self.assertEqual(class_of[sym], c)
+
+    def test_updated_by_edges(self):
+        nfa = NFA('abc')
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state(final=True)
+        nfa.add_multiple_edges(s0, {'a': s1, 'b': s1})
+        self.assertEqual(len(nfa.symbol_classes()[1]), 2)
+        self.assertTrue(nfa.test_input('b'))
+        nfa.new_edge(s1, 'b', s1)
+        self.assertEqual(len(nfa.symbol_classes()[1]), 3)
+        self.assertTrue(nfa.test_input('bb'))
+        self.assertFalse(nfa.test_input('ba'))
+
+    def test_dfa(self):
+        """A byte alphabet with few distinct symbols"""
+        alphabet = [chr(i) for i in range(256)]
+        nfa = compile_regex('(ab|[0-9])*[^a]', alphabet)
+        dfa = nfa.subset_construct_dfa()
+        self.assertEqual(len(dfa.symbol_classes()[1]), 4)
+        matcher = CompiledDFA(dfa)
+        self.assertEqual(matcher.no_of_columns, 4)
+        mdfa, _ = dfa.minimize()
+        for v in ['ab1x', 'a', 'x', 'ab', '12', 'abab0b', 'aab']:
+            self.assertEqual(matcher.accepts(v), nfa.test_input(v), 'Mismatch on "{}"'.format(v))
+            self.assertEqual(mdfa.test_input(v), nfa.test_input(v), 'Mismatch on "{}"'.format(v))
+
+        nfa.enable_lazy_dfa(cache_size=100)
+        for v in ['ab1x', 'a', 'x', 'ab', '12', 'abab0b', 'aab']:
+            self.assertEqual(nfa.test_input(v), matcher.accepts(v), 'Mismatch on "{}"'.format(v))
+
+
+class TestSerialization(unittest.TestCase):
+    """Test saving and loading NFAs and compiled DFAs"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'automaton.bin')
+        patterns = {
+            'int': compile_regex('[+-]?[0-9]+', '0123456789+-ab'),
+            7: compile_regex('a(b|0)*', '0123456789+-ab'),
+        }
+        self.nfa = NFA.tagged_union(patterns)
+        self.vectors = ['12', '-3', 'ab0b', 'a', '+', 'ba', '', '1a']
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_nfa(self):
+        for sparse in (False, True):
+            nfa = self.nfa
+            vectors = self.vectors
+            if sparse:
+                vectors = ['a', 'ab', 'abb', 'b', '']
+                nfa = NFA.tagged_union({'x': compile_regex('ab*', 'ab', sparse=True)})
+                hole = nfa.new_state()
+                nfa.new_state(name='after hole')
+                nfa.del_state(hole)
+            nfa.save(self.path)
+            loaded = NFA.load(self.path)
+            self.assertEqual(loaded.sparse, nfa.sparse)
+            self.assertEqual(loaded.get_states(), nfa.get_states())
+            self.assertEqual(loaded.get_initial(), nfa.get_initial())
+            self.assertEqual(sorted(loaded.get_finals()), sorted(nfa.get_finals()))
+            for p in nfa.get_states():
+                self.assertEqual(loaded.get_edges_from_state(p), nfa.get_edges_from_state(p))
+                self.assertEqual(loaded.get_tags(p), nfa.get_tags(p))
+            for v in vectors:
+                self.assertEqual(loaded.matching_tags(v), nfa.matching_tags(v), 'Mismatch on "{}"'.format(v))
+
+            # New states continue after the saved ones
+            self.assertEqual(loaded.new_state(), nfa.new_state())
+
+    def test_compiled_dfa(self):
+        matcher = self.nfa.compile_dfa(minimize=True)
+        matcher.save(self.path)
+        loaded = CompiledDFA.load(self.path)
+        self.assertEqual(loaded.no_of_states, matcher.no_of_states)
+        self.assertEqual(loaded.no_of_columns, matcher.no_of_columns)
+        for v in self.vectors:
+            self.assertEqual(loaded.accepts(v), matcher.accepts(v), 'Mismatch on "{}"'.format(v))
+            self.assertEqual(loaded.matching_tags(v), matcher.matching_tags(v), 'Mismatch on "{}"'.format(v))
+        self.assertRaises(NFAInvalidInput, loaded.accepts, '1x')
+
+        # A loaded DFA can be saved again
+        copy_path = os.path.join(self.dir, 'copy.bin')
+        loaded.save(copy_path)
+        with open(self.path, 'rb') as f1, open(copy_path, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_bad_files(self):
+        self.nfa.save(self.path)
+        self.assertRaises(NFAException, CompiledDFA.load, self.path)
+        self.nfa.compile_dfa().save(self.path)
+        self.assertRaises(NFAException, NFA.load, self.path)
+
+        nfa = NFA([('a', 1)])
+        nfa.build_from_string([('a', 1)])
+        self.assertRaises(NFAException, nfa.save, self.path)
+
+
+class TestSparseStorage(unittest.TestCase):
+    """Test that the sparse layout behaves like the dense one"""
+
+    def setUp(self):
+        self.dense = NFA('012')
+        self.sparse = NFA('012', sparse=True)
+        for fa in (self.dense, self.sparse):
+            s0 = fa.new_state(initial=True)
+            s1 = fa.new_state()
+            s2 = fa.new_state(final=True)
+            fa.new_edge(s0, '0', s1)
+            fa.new_edge(s0, Epsilon, s1)
+            fa.new_edge_set(s1, '1', {s1, s2})
+            fa.add_multiple_edges(s2, {'2': s0})
+
+    def test_edges(self):
+        self.assertTrue(self.sparse.sparse)
+        self.assertFalse(self.dense.sparse)
+        for p in self.dense.get_states():
+            self.assertEqual(self.sparse.get_edges_from_state(p), self.dense.get_edges_from_state(p))
+        for sym in '012':
+            self.assertEqual(self.sparse.get_edges_on_symbol(sym), self.dense.get_edges_on_symbol(sym))
+            for p in self.dense.get_states():
+                self.assertEqual(self.sparse.delta(p, sym), self.dense.delta(p, sym))
+        self.assertEqual(self.sparse.get_edges_on_symbol(Epsilon), {0: {1}})
+        self.assertRaises(NFAInvalidInput, self.sparse.delta, 0, '3')
+        self.assertRaises(NFAInvalidInput, self.sparse.new_edge, 0, '3', 1)
+
+    def test_matching(self):
+        for v in ['1', '01', '011', '0112', '01121', '', '0', '2', '10']:
+            self.assertEqual(self.sparse.test_input(v), self.dense.test_input(v), 'Mismatch on "{}"'.format(v))
+
+        fa = (self.sparse | self.sparse.star()) + self.sparse
+        self.assertTrue(fa.sparse)
+        dfa = fa.subset_construct_dfa()
+        self.assertTrue(dfa.sparse)
+        for v in ['1', '11', '1211', '111', '0']:
+            self.assertEqual(dfa.test_input(v), fa.test_input(v), 'Mismatch on "{}"'.format(v))
+
+    def test_del_state(self):
+        self.sparse.del_state(1)
+        self.assertFalse(self.sparse.has_edge(0, 1))
+        self.assertEqual(self.sparse.get_edges_on_symbol('0'), {})
+        self.assertFalse(self.sparse.test_input('1'))
+
+
+class TestCompiledDFA(unittest.TestCase):
+    """Test matching with a compiled flat table DFA"""
+
+    def setUp(self):
+        """NFA accepting digits with an optional sign"""
+        nfa = NFA('0123456789+-ab')
+        sInit = nfa.new_state(initial=True)
+        sSign = nfa.new_state()
+        sDigit = nfa.new_state(final=True)
+
+        nfa.new_edge(sInit, '+', sSign)
+        nfa.new_edge(sInit, '-', sSign)
+        nfa.new_edge(sInit, Epsilon, sSign)
+        for s in '0123456789':
+            nfa.new_edge(sSign, s, sDigit)
+            nfa.new_edge(sDigit, s, sDigit)
+        self.nfa = nfa
+
+    def test_vectors(self):
+        matcher = self.nfa.compile_dfa()
+        self.assertEqual(matcher.no_of_columns, 3, 'Expected columns for digits, signs and unused symbols')
+        for v in ['123', '0', '+1', '-1', '+321', '-321', 'ab', '+-0', '12+21', '-12ab', '', '+']:
+            self.assertEqual(matcher.accepts(v), self.nfa.test_input(v), 'Mismatch on "{}"'.format(v))
+
+    def test_dead_states_dropped(self):
+        dfa = self.nfa.subset_construct_dfa()
+        matcher = CompiledDFA(dfa)
+        self.assertLess(matcher.no_of_states, dfa.no_of_states)
+        self.assertEqual(matcher.get_state_map()[dfa.get_initial()], 0)
+        self.assertFalse(matcher.accepts('a*'), 'Symbol after dead state should not be looked up')
+        self.assertRaises(NFAInvalidInput, matcher.accepts, '1*')
+
+    def test_requires_dfa(self):
+        self.assertRaises(NFAException, CompiledDFA, self.nfa)
+        self.assertRaises(NFAException, CompiledDFA, NFA('01'))
+
+
+class TestLazyDFA(unittest.TestCase):
+    """Test matching with an on the fly built DFA"""
+
+    def setUp(self):
+        """NFA accepting (0|1)*0(0|1)(0|1)"""
+        nfa = NFA('01')
+        s0 = nfa.new_state(initial=True)
+        s1 = nfa.new_state()
+        s2 = nfa.new_state()
+        s3 = nfa.new_state(final=True)
+        nfa.add_multiple_edges(s0, {'0': s0, '1': s0})
+        nfa.new_edge(s0, '0', s1)
+        nfa.add_multiple_edges(s1, {'0': s2, '1': s2})
+        nfa.add_multiple_edges(s2, {'0': s3, '1': s3})
+        self.nfa = nfa
+        self.vectors = [format(i, 'b') for i in range(256)]
+        self.expected = [nfa.test_input(v) for v in self.vectors]
+
+    def test_lru(self):
+        nfa = self.nfa
+        nfa.enable_lazy_dfa(cache_size=64)
+        self.assertEqual([nfa.test_input(v) for v in self.vectors], self.expected)
+        lazy = nfa._lazy_dfa
+        self.assertTrue(lazy.hits > lazy.misses)
+        self.assertLessEqual(len(lazy.cache), 64)
+
+    def test_thrashing(self):
+        """A cache too small for the working set is bypassed"""
+        nfa = self.nfa
+        for eviction in ('lru', 'flush'):
+            nfa.enable_lazy_dfa(cache_size=2, eviction=eviction)
+            self.assertEqual([nfa.test_input(v) for v in self.vectors], self.expected)
+            lazy = nfa._lazy_dfa
+            self.assertTrue(lazy.evictions > 0)
+            self.assertLessEqual(len(lazy.cache), 2)
+
+    def test_invalidation(self):
+        nfa = self.nfa
+        nfa.enable_lazy_dfa()
+        self.assertFalse(nfa.test_input('1'))
+        nfa.set_as_final_state(0)
+        self.assertTrue(nfa.test_input('1'))
+        self.assertRaises(NFAInvalidInput, nfa.test_input, '2')
+        nfa.disable_lazy_dfa()
+        self.assertTrue(nfa.test_input('1'))
+
+    def test_options(self):
+        self.assertRaises(NFAException, self.nfa.enable_lazy_dfa, eviction='fifo')
+        self.assertRaises(NFAException, self.nfa.enable_lazy_dfa, cache_size=0)
+
+
+class TestRegex(unittest.TestCase):
+    """Test compiling regular expressions, using module re as reference"""
+
+    alphabet = 'abc01-*'
+
+    def assertSameAsRe(self, pattern, max_length=5):
+        nfa = compile_regex(pattern, self.alphabet)
+        for n in range(max_length + 1):
+            for v in itertools.product('abc01-*', repeat=n):
+                v = ''.join(v)
+                self.assertEqual(nfa.test_input(v), re.fullmatch(pattern, v) is not None,
+                                 'Mismatch for pattern {!r} on "{}"'.format(pattern, v))
+
+    def test_patterns(self):
+        patterns = [
+            'abc', 'a|b|', '(ab|c)*0', 'a+b?', '[a-c]+1', '[^a0]*', '.-.', 'a\\*b', '[*-]+',
+            'a{2}', 'a{1,}b', '(a|b){1,3}c?', '(a*)*', '()', 'a{0}b', '(0|1(01*0)*1)*',
+        ]
+        for pattern in patterns:
+            self.assertSameAsRe(pattern, max_length=4)
+
+    def test_build_from_regex(self):
+        nfa = NFA(self.alphabet)
+        nfa.build_from_regex('(ab|c)*0')
+        self.assertTrue(nfa.test_input('abcab0'))
+        self.assertFalse(nfa.test_input('abcb0'))
+
+    def test_cache(self):
+        nfa_module._regex_cache.clear()
+        nfa = compile_regex('a(b|c)*', self.alphabet)
+        self.assertFalse(nfa.sparse)
+        self.assertIn(('a(b|c)*', frozenset(self.alphabet)), nfa_module._regex_cache)
+        sparse = compile_regex('a(b|c)*', self.alphabet, sparse=True)
+        self.assertTrue(sparse.sparse)
+        self.assertEqual(len(nfa_module._regex_cache), 1)
+        self.assertTrue(sparse.test_input('abcb'))
+
+    def test_compiled_instances_are_independent(self):
+        """Changes to one compiled NFA do not show in later compiles of the same pattern"""
+        nfa = compile_regex('ab*', self.alphabet)
+        nfa.enable_stats()
+        nfa.enable_lazy_dfa()
+        nfa.star_inplace()
+        self.assertTrue(nfa.test_input('abab'))
+
+        again = compile_regex('ab*', self.alphabet)
+        self.assertIsNot(again, nfa)
+        self.assertIsNone(again.stats)
+        self.assertFalse(again.test_input('abab'))
+        self.assertFalse(again.test_input(''))
+        self.assertTrue(again.test_input('abbb'))
+
+    def test_errors(self):
+        for pattern in ['(ab', 'ab)', 'a{2', 'a{3,1}', '*a', '[a', '[c-a]', 'a|*', 'a\\']:
+            self.assertRaises(NFASyntaxError, compile_regex, pattern, self.alphabet)
+        self.assertRaises(NFAInvalidInput, compile_regex, 'abd', self.alphabet)
+
+
+class TestReverseIndex(unittest.TestCase):
+    def build(self, sparse):
+        fa = NFA('01', sparse=sparse)
+        states = [fa.new_state() for _ in range(8)]
+        for i, p in enumerate(states):
+            fa.new_edge(p, '01'[i % 2], states[(i * 3 + 1) % 8])
+            fa.new_edge(p, '1', states[(i + 2) % 8])
+            fa.new_edge(p, Epsilon, p)
+        fa.set_initial_state(states[0])
+        fa.set_as_final_state(states[5])
+        return fa, states
+
+    def assertIndexConsistent(self, fa):
+        states = fa.get_states()
+        for p in states:
+            for q in states:
+                expected = any(q in t for t in fa.get_edges_from_state(p).values())
+                self.assertEqual(fa.has_edge(p, q), expected, 'has_edge({}, {})'.format(p, q))
+        for s in ['0', '1', Epsilon]:
+            expected = {p: set(fa.get_edges_from_state(p)[s])
+                        for p in states if fa.get_edges_from_state(p).get(s)}
+            self.assertEqual(fa.get_edges_on_symbol(s), expected)
+
+    def test_interleaved_edits(self):
+        for sparse in [False, True]:
+            fa, states = self.build(sparse)
+            self.assertIndexConsistent(fa)
+            fa.del_state(states[3])
+            fa.new_edge(states[4], '0', states[2])
+            s8 = fa.new_state()
+            fa.new_edge(s8, '1', states[0])
+            fa.new_edge(states[1], '0', s8)
+            self.assertIndexConsistent(fa)
+            fa.del_state(states[0])
+            self.assertIndexConsistent(fa)
+            self.assertIsNone(fa.get_initial())
+
+    def test_del_states(self):
+        for sparse in [False, True]:
+            fa, states = self.build(sparse)
+            other, _ = self.build(sparse)
+            fa.has_edge(states[0], states[1])
+            fa.del_states([states[1], states[5], states[6]])
+            for sid in [states[1], states[5], states[6]]:
+                other.del_state(sid)
+            self.assertEqual(fa.get_states(), other.get_states())
+            self.assertEqual(fa.get_finals(), [])
+            for p in fa.get_states():
+                self.assertEqual(fa.get_edges_from_state(p), other.get_edges_from_state(p))
+            self.assertIndexConsistent(fa)
+            self.assertEqual(fa.test_input('0'), other.test_input('0'))
+
+
+class TestTrim(unittest.TestCase):
+    def setUp(self):
+        self.fa = fa = NFA('01')
+        s0 = fa.new_state(initial=True)
+        s1 = fa.new_state()
+        s2 = fa.new_state(final=True)
+        dead = fa.new_state()
+        unreachable = fa.new_state()
+        fa.new_edge(s0, '0', s1)
+        fa.new_edge(s1, '1', s2)
+        fa.new_edge(s2, '0', s0)
+        fa.new_edge(s0, '1', dead)
+        fa.new_edge(dead, '0', dead)
+        fa.new_edge(unreachable, '1', s2)
+        fa.set_as_final_state(s2, tag='x')
+        self.vectors = [''.join(p) for n in range(6) for p in itertools.product('01', repeat=n)]
+
+    def test_trim(self):
+        fa = self.fa
+        expected = [fa.test_input(v) for v in self.vectors]
+        self.assertEqual(fa.trim(), 2)
+        self.assertEqual(sorted(fa.get_states()), [0, 1, 2])
+        self.assertEqual(fa.get_initial(), 0)
+        self.assertEqual(fa.get_finals(), [2])
+        self.assertEqual(fa.get_tags(2), {'x'})
+        self.assertFalse(fa.has_edge(0, 3))
+        self.assertEqual([fa.test_input(v) for v in self.vectors], expected)
+        self.assertEqual(fa.trim(), 0)
+
+    def test_trim_keeps_initial(self):
+        fa = NFA('01')
+        s0 = fa.new_state(initial=True)
+        fa.new_edge(s0, '0', fa.new_state())
+        self.assertEqual(fa.trim(), 1)
+        self.assertEqual(list(fa.get_states()), [0])
+        self.assertFalse(fa.test_input(''))
+        self.assertRaises(NFAException, NFA('01').trim)
+
+    def test_trim_composed(self):
+        fa = NFA('ab')
+        fa.build_from_string('ab')
+        other = NFA('ab')
+        other.new_edge(other.new_state(initial=True), 'a', other.new_state())
+        combined = (fa + other).star()
+        expected = [combined.test_input(v) for v in ['', 'ab', 'abab', 'a', 'ba']]
+        self.assertEqual(combined.trim(), 2)
+        self.assertEqual([combined.test_input(v) for v in ['', 'ab', 'abab', 'a', 'ba']], expected)
+
+    def test_subset_construct_trimmed(self):
+        fa = self.fa
+        dfa = fa.subset_construct_dfa(trim=True)
+        self.assertLess(dfa.no_of_states, fa.subset_construct_dfa().no_of_states)
+        for v in self.vectors:
+            self.assertEqual(dfa.test_input(v), fa.test_input(v), v)
+        self.assertEqual(fa.no_of_states, 5)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.fa = NFA('ab')
+        self.fa.build_from_regex('(a|b)*a(a|b)')
+
+    def test_disabled(self):
+        self.assertIsNone(self.fa.stats)
+        self.assertTrue(self.fa.test_input('bab'))
+        self.assertIsNone(self.fa.stats)
+
+    def test_test_input(self):
+        fa = self.fa
+        stats = fa.enable_stats()
+        self.assertIsInstance(stats, MatchStats)
+        self.assertIs(fa.enable_stats(), stats)
+        expected = [fa.test_input(v) for v in ['bab', 'ab', 'bbb']]
+        fa.disable_stats()
+        self.assertEqual(expected, [fa.test_input(v) for v in ['bab', 'ab', 'bbb']])
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['counters']['inputs'], 3)
+        self.assertEqual(snapshot['counters']['symbols'], 8)
+        self.assertEqual(sum(snapshot['active_sizes'].values()), 8 + 3)
+        self.assertEqual(snapshot['max_active'], max(snapshot['active_sizes']))
+        self.assertEqual(snapshot['counters']['cache_misses'] + snapshot['counters']['cache_hits'], 3)
+        self.assertIn('match', snapshot['times'])
+
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {'counters': {}, 'times': {}, 'active_sizes': {}, 'max_active': 0})
+        self.assertEqual(snapshot['counters']['inputs'], 3)
+
+    def test_lazy_dfa(self):
+        fa = self.fa
+        fa.enable_lazy_dfa()
+        stats = fa.enable_stats()
+        self.assertTrue(fa.test_input('aaaa'))
+        counters = stats.snapshot()['counters']
+        self.assertEqual(counters['dfa_cache_hits'] + counters['dfa_cache_misses'], 4)
+        self.assertGreater(counters['dfa_cache_hits'], 0)
+
+    def test_move_closure_subset(self):
+        fa = NFA('ab')
+        fa.build_from_regex('(a|b)*a')
+        stats = fa.enable_stats()
+        initial = fa.closure(fa.get_initial())
+        self.assertEqual(fa.move(initial, 'a'), fa.closure(fa.move(initial, 'a')))
+        dfa = fa.subset_construct_dfa()
+        counters = stats.snapshot()['counters']
+        self.assertEqual(counters['moves'], 2)
+        self.assertEqual(counters['closures'], 4)  # move takes the closure of its input
+        self.assertGreater(counters['closure_iterations'], 0)
+        self.assertEqual(counters['dfa_states'], dfa.no_of_states)
+        self.assertEqual(set(stats.times), {'tables', 'move', 'closure', 'subset_construction'})
+
+
+class TestProduct(unittest.TestCase):
+    patterns = ['(a|b)*a', '(ab)*', 'a*b*', '(a|b)(a|b)', 'b+a?', '()', '(a|b)*abb(a|b)*']
+
+    def regex(self, pattern, alphabet='ab'):
+        nfa = NFA(alphabet)
+        nfa.build_from_regex(pattern)
+        return nfa
+
+    def vectors(self, alphabet='ab'):
+        return [''.join(p) for n in range(7) for p in itertools.product(alphabet, repeat=n)]
+
+    def test_intersection(self):
+        for p1, p2 in itertools.product(self.patterns, repeat=2):
+            n1, n2 = self.regex(p1), self.regex(p2)
+            product = n1 & n2
+            self.assertTrue(product.is_epsilon_free())
+            for v in self.vectors():
+                self.assertEqual(product.test_input(v), n1.test_input(v) and n2.test_input(v),
+                                 '{} & {} on "{}"'.format(p1, p2, v))
+
+    def test_difference(self):
+        for p1, p2 in itertools.product(self.patterns, repeat=2):
+            n1, n2 = self.regex(p1), self.regex(p2)
+            product = n1 - n2
+            for v in self.vectors():
+                self.assertEqual(product.test_input(v), n1.test_input(v) and not n2.test_input(v),
+                                 '{} - {} on "{}"'.format(p1, p2, v))
+
+    def test_mixed_alphabets(self):
+        n1 = self.regex('(a|b|c)*', 'abc')
+        n2 = self.regex('(a|b)*', 'ab')
+        for v in self.vectors('abc'):
+            self.assertEqual((n1 & n2).test_input(v), 'c' not in v)
+            self.assertEqual((n1 - n2).test_input(v), 'c' in v)
+
+    def test_tags(self):
+        tagged = NFA.tagged_union({'x': compile_regex('a+', 'ab'), 'y': compile_regex('b', 'ab')})
+        product = tagged & self.regex('aa')
+        self.assertEqual(product.matching_tags('aa'), {'x'})
+        self.assertEqual(product.matching_tags('b'), set())
+
+    def test_complement(self):
+        for pattern in self.patterns:
+            nfa = self.regex(pattern)
+            dfa = nfa.subset_construct_dfa()
+            complement = dfa.complement()
+            self.assertTrue(complement.is_deterministic())
+            for v in self.vectors():
+                self.assertEqual(complement.test_input(v), not nfa.test_input(v), '{} on "{}"'.format(pattern, v))
+        self.assertRaises(NFAException, self.regex('a|ab').complement)
+        self.assertRaises(NFAException, NFA('ab').complement)
+
+
+class TestLanguageChecks(unittest.TestCase):
+    patterns = ['(a|b)*a', '(ab)*', 'a*b*', '(a|b)(a|b)', 'b+a?', '()', '(a|b)*abb(a|b)*', '(a*b*)*', '(a|b)*']
+
+    def regex(self, pattern, alphabet='ab'):
+        nfa = NFA(alphabet)
+        nfa.build_from_regex(pattern)
+        return nfa
+
+    def language(self, nfa, max_length=6):
+        return set(''.join(p) for n in range(max_length + 1) for p in itertools.product('ab', repeat=n)
+                   if nfa.test_input(p))
+
+    def test_is_empty(self):
+        for pattern in self.patterns:
+            result = self.regex(pattern).is_empty()
+            self.assertIsInstance(result, CheckResult)
+            self.assertFalse(result)
+            self.assertTrue(self.regex(pattern).test_input(result.counterexample))
+        self.assertEqual(self.regex('(a|b)*abb').is_empty().counterexample, list('abb'))
+        empty = self.regex('a') & self.regex('b')
+        result = empty.is_empty()
+        self.assertTrue(result)
+        self.assertIsNone(result.counterexample)
+
+    def test_is_equivalent(self):
+        self.assertTrue(self.regex('(a*b*)*').is_equivalent(self.regex('(a|b)*')))
+        self.assertTrue(self.regex('a(ba)*').is_equivalent(self.regex('(ab)*a')))
+        for p1, p2 in itertools.product(self.patterns, repeat=2):
+            n1, n2 = self.regex(p1), self.regex(p2)
+            result = n1.is_equivalent(n2)
+            self.assertEqual(bool(result), self.language(n1) == self.language(n2), '{} == {}'.format(p1, p2))
+            if not result:
+                v = result.counterexample
+                self.assertNotEqual(n1.test_input(v), n2.test_input(v), '{} == {} on {}'.format(p1, p2, v))
+
+    def test_is_subset_of(self):
+        for p1, p2 in itertools.product(self.patterns, repeat=2):
+            n1, n2 = self.regex(p1), self.regex(p2)
+            result = n1.is_subset_of(n2)
+            self.assertEqual(bool(result), self.language(n1) <= self.language(n2), '{} <= {}'.format(p1, p2))
+            if not result:
+                v = result.counterexample
+                self.assertTrue(n1.test_input(v) and not n2.test_input(v), '{} <= {} on {}'.format(p1, p2, v))
+
+    def test_mixed_alphabets(self):
+        n1 = self.regex('(a|b)*', 'ab')
+        n2 = self.regex('(a|b|c)*', 'abc')
+        self.assertTrue(n1.is_subset_of(n2))
+        self.assertEqual(n2.is_subset_of(n1).counterexample, ['c'])
+        self.assertEqual(n1.is_equivalent(n2).counterexample, ['c'])
+
+
+class TestTokenize(unittest.TestCase):
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789 =+'
+
+    def setUp(self):
+        self.lexer = NFA.tagged_union([
+            compile_regex('if', self.alphabet),
+            compile_regex('[a-z][a-z0-9]*', self.alphabet),
+            compile_regex('[0-9]+', self.alphabet),
+            compile_regex('==|=|\\+', self.alphabet),
+            compile_regex(' +', self.alphabet),
+        ])
+
+    def test_longest_match(self):
+        lexer = self.lexer
+        self.assertEqual(lexer.longest_match('if x'), (2, 0))
+        self.assertEqual(lexer.longest_match('ifs'), (3, 1))
+        self.assertEqual(lexer.longest_match('x == 12', 2), (4, 3))
+        self.assertEqual(lexer.longest_match('x = 12', 4), (6, 2))
+        self.assertIsNone(lexer.longest_match('?x'))
+        self.assertIsNone(lexer.longest_match('x', 1))
+
+    def test_longest_match_backtracks(self):
+        nfa = compile_regex('a|abcd', 'abcd')
+        self.assertEqual(nfa.longest_match('abcx'), (1, None))
+        self.assertEqual(nfa.longest_match('abcd'), (4, None))
+        self.assertEqual(compile_regex('a*', 'ab').longest_match('b'), (0, None))
+
+    def test_tokenize(self):
+        tokens = list(self.lexer.tokenize('if x1 == 42+iffy'))
+        self.assertEqual(tokens, [(0, 0, 2), (4, 2, 3), (1, 3, 5), (4, 5, 6), (3, 6, 8), (4, 8, 9),
+                                  (2, 9, 11), (3, 11, 12), (1, 12, 16)])
+        self.assertEqual(list(self.lexer.tokenize(iter('12 3'))), [(2, 0, 2), (4, 2, 3), (2, 3, 4)])
+        self.assertEqual(list(self.lexer.tokenize('')), [])
+
+    def test_tokenize_reads_ahead_once(self):
+        """Read ahead past a token that found no longer token is not repeated for later tokens"""
+        class CountingText(object):
+            def __init__(self, text):
+                self.text = text
+                self.reads = 0
+
+            def __len__(self):
+                return len(self.text)
+
+            def __getitem__(self, i):
+                self.reads += 1
+                return self.text[i]
+
+        lexer = NFA.tagged_union({'a': compile_regex('a', 'ab'), 'ab': compile_regex('a*b', 'ab')})
+        text = CountingText('a' * 1000)
+        self.assertEqual(list(lexer.tokenize(text)), [('a', i, i + 1) for i in range(1000)])
+        self.assertLessEqual(text.reads, 3 * 1000)
+        self.assertEqual(list(lexer.tokenize('aab' + 'a' * 4 + 'b' + 'aa')),
+                         [('ab', 0, 3), ('ab', 3, 8), ('a', 8, 9), ('a', 9, 10)])
+
+    def test_tie_goes_to_first_pattern(self):
+        """A token matched by several patterns is tagged with the pattern listed first, not the lowest tag"""
+        A = self.alphabet
+        lexer = NFA.tagged_union({'keyword': compile_regex('if|while', A),
+                                  'ident': compile_regex('[a-z]+', A),
+                                  'space': compile_regex(' +', A)})
+        self.assertEqual(list(lexer.tokenize('if x while')),
+                         [('keyword', 0, 2), ('space', 2, 3), ('ident', 3, 4), ('space', 4, 5), ('keyword', 5, 10)])
+        self.assertEqual(lexer.subset_construct_dfa().minimize()[0].longest_match('while'), (5, 'keyword'))
+
+        mixed = NFA.tagged_union({1: compile_regex('if', A), 'name': compile_regex('[a-z]+', A)})
+        self.assertEqual(mixed.longest_match('if'), (2, 1))
+
+        path = os.path.join(tempfile.mkdtemp(), 'lexer.nfa')
+        lexer.save(path)
+        self.assertEqual(list(NFA.load(path).tokenize('while')), [('keyword', 0, 5)])
+
+    def test_tokenize_errors(self):
+        tokens = self.lexer.tokenize('x ? y')
+        self.assertEqual(next(tokens), (1, 0, 1))
+        self.assertEqual(next(tokens), (4, 1, 2))
+        self.assertRaises(NFAException, next, tokens)
+        self.assertRaises(NFAException, list, compile_regex('a*', 'ab').tokenize('ab'))
+
+
+class TestBatchNumpy(unittest.TestCase):
+    """Test vectorized batch matching of a compiled DFA"""
+
+    def setUp(self):
+        self.nfa = compile_regex('[+-]?[0-9]+', '0123456789+-ab')
+        self.vectors = ['123', '0', '+1', '-1', '+321', '-321', 'ab', '+-0', '12+21', '-12ab', '', '+']
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_accepts_batch(self):
+        matcher = self.nfa.compile_dfa()
+        result = matcher.accepts_batch(self.vectors)
+        self.assertEqual(result.dtype, bool)
+        self.assertEqual(list(result), [matcher.accepts(v) for v in self.vectors])
+        self.assertEqual(list(matcher.accepts_batch([list(v) for v in self.vectors])),
+                         [matcher.accepts(v) for v in self.vectors])
+        self.assertEqual(len(matcher.accepts_batch([])), 0)
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_accepts_batch_loaded(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'dfa.bin')
+            self.nfa.compile_dfa(minimize=True).save(path)
+            matcher = CompiledDFA.load(path)
+            self.assertEqual(list(matcher.accepts_batch(self.vectors)), [self.nfa.test_input(v) for v in self.vectors])
+            del matcher
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_accepts_batch_invalid(self):
+        matcher = self.nfa.compile_dfa()
+        self.assertRaises(NFAInvalidInput, matcher.accepts_batch, ['12', 'a*'])
+        self.assertRaises(NFAInvalidInput, matcher.accepts_batch, ['12', '\u20ac'])
+        self.assertRaises(NFAInvalidInput, matcher.accepts_batch, [['1', 'x']])
+
+    def test_without_numpy(self):
+        matcher = self.nfa.compile_dfa()
+        with mock.patch.object(nfa_module, 'numpy', None):
+            self.assertRaises(NFAException, matcher.accepts_batch, self.vectors)
+
+
 if __name__ == '__main__':
     unittest.main()